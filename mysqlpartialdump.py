@@ -3,16 +3,48 @@ from MySQLdb import cursors
 import sys
 import argparse
 from sys import stderr
-from datetime import datetime
-from collections import defaultdict
-import codecs
+from datetime import datetime, timedelta
+from collections import defaultdict, OrderedDict, deque
+import hashlib
+import math
+import threading
+import Queue
+from itertools import izip_longest
+import tempfile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import json
+import time
+import os
+try:
+    import resource
+except ImportError:
+    # Not available on Windows. Peak memory just won't be reported
+    resource = None
 
 BULK_INSERT_SIZE = 5000
+TRANSFORM_CACHE_SIZE = 100000
+OUTPUT_BUFFER_SIZE = 64 * 1024
+START_THREADS = 4
+SECONDARY_INDEX_PREFIXES = ('KEY ', 'UNIQUE KEY ', 'FULLTEXT KEY ',
+                            'SPATIAL KEY ', 'CONSTRAINT ')
+JOIN_HOPS = 3
+# Powers of two so a batch is never padded to more than twice its size
+PREPARED_ARITIES = tuple([2 ** i for i in xrange(13)])
+PROBE_DUPLICATE_RATIO = 0.5
+PROGRESS_INTERVAL = 10
+# How many batches each encoding process can have waiting
+ENCODE_QUEUE_SIZE = 2
+ESTIMATE_ROUNDS = 50
+ESTIMATE_CHUNK_BYTES = 256 * 1024 * 1024
 
 LOG_NONE = 0
 LOG_INFO = 1
 LOG_DEBUG = 2
 DEBUG_LEVEL = LOG_NONE
+LOG_NAMES = { LOG_INFO: 'info', LOG_DEBUG: 'debug' }
+EVENTS_PER_SECOND = 100
+EVENT_FIELD_LENGTH = 200
 
 BIDIRECTIONAL = 'bidirectional'
 ALLOW_DUPLICATES = 'allow duplicates'
@@ -22,13 +54,62 @@ def get_schema(cursor, name):
     cursor.execute("DESCRIBE `%s`"%name)
     return cursor.fetchall()
 
+def _json_default(value):
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return unicode(value)
+
+class EventLog(object):
+    """Writes structured events as JSON lines. Nothing about an event is
+    formatted unless its level is enabled, so events are close to free when
+    logging is off. Callers should pass values rather than preformatted
+    strings for the same reason.
+
+    Each kind of event is rate limited to per_second events a second. The
+    number of events dropped is added to the next one that gets through.
+    """
+    def __init__(self, stream=stderr, per_second=EVENTS_PER_SECOND):
+        self.stream = stream
+        self.per_second = per_second
+        # { event: [window start, events written, events dropped] }
+        self.windows = {}
+
+    def enabled(self, level):
+        return DEBUG_LEVEL >= level
+
+    def emit(self, level, event, **fields):
+        if DEBUG_LEVEL < level:
+            return
+
+        now = time.time()
+        window = self.windows.get(event)
+        if window is None or now - window[0] >= 1:
+            if window and window[2]:
+                fields['dropped'] = window[2]
+            window = self.windows[event] = [now, 0, 0]
+        if window[1] >= self.per_second:
+            window[2] += 1
+            return
+        window[1] += 1
+
+        for name, value in fields.items():
+            if isinstance(value, basestring) and \
+                    len(value) > EVENT_FIELD_LENGTH:
+                fields[name] = value[:EVENT_FIELD_LENGTH] + '...'
+        fields['time'] = datetime.now().isoformat()
+        fields['level'] = LOG_NAMES[level]
+        fields['event'] = event
+        self.stream.write(json.dumps(fields, default=_json_default) + '\n')
+
+events = EventLog()
+
 def debug(msg):
-    if DEBUG_LEVEL >= LOG_DEBUG:
-        stderr.write('DEBUG: %s %s\n'%(datetime.now(), msg))
+    events.emit(LOG_DEBUG, 'message', message=msg)
 
 def info(msg):
-    if DEBUG_LEVEL >= LOG_INFO:
-        stderr.write('INFO: %s %s\n'%(datetime.now(), msg[:100]))
+    events.emit(LOG_INFO, 'message', message=msg)
 
 def make_safe(value):
     if value is None:
@@ -45,11 +126,38 @@ class Pk(object):
         self.columns = columns
         self.options = set(options)
         self.batch_size = BULK_INSERT_SIZE
+        # The columns to dump. None means all of them
+        self.included = None
+        self.excluded = set()
+        # { column: value to dump in place of the real one }
+        self.replacements = {}
 
     def in_batches(self, batch_size):
         self.batch_size = batch_size
         return self
 
+    def including(self, *columns):
+        '''Only dumps the given columns. The primary key and the columns
+        relationships follow are still fetched so the crawl can carry on'''
+        self.included = set(columns)
+        return self
+
+    def excluding(self, *columns):
+        '''Leaves the given columns out of the dump. As with including,
+        columns that are needed to crawl are still fetched'''
+        self.excluded.update(columns)
+        return self
+
+    def replacing(self, **values):
+        '''Dumps a fixed value for each of the given columns instead of the
+        real one. E.g.
+        >>> pk = Pk(['id']).replacing(attachment=None, notes='')
+        >>> sorted(pk.replacements.items())
+        [('attachment', None), ('notes', '')]
+        '''
+        self.replacements.update(values)
+        return self
+
     def __repr__(self):
         return "%s (%s) in batches of %d"%(
                 self.columns, ", ".join(self.options), self.batch_size)
@@ -64,6 +172,9 @@ class CustomRelationship(object):
     ...     if row['has_pet']:
     ...          return ('pet', ('owner_id', row['id']))
     ...     return None
+
+    A third item of (sql, args) can be added to the tuple to only follow to
+    rows that also match the SQL, as with Relationship.where
     """
     def __init__(self, from_table, callback):
         self.from_table = from_table
@@ -72,6 +183,10 @@ class CustomRelationship(object):
     def create_callbacks(self):
         return [(self.from_table, self.callback)]
 
+    def edges(self):
+        # Where a callback leads can't be known without running it
+        return []
+
 class Relationship(object):
     """Defines a relationship from one table to another. Should not be used
     directly but instead From should be used:
@@ -86,6 +201,7 @@ class Relationship(object):
         self.to_table = to_table
         self.to_columns = to_columns
         self.options = set()
+        self.predicate = None
 
     def to(self, to_table, *to_columns):
         self.to_table = to_table
@@ -96,27 +212,52 @@ class Relationship(object):
         self.options.add(BIDIRECTIONAL)
         return self
 
+    def where(self, sql, *args):
+        '''Only follows the relationship to rows that also match some SQL.
+        This is ANDed in to the query for the rows followed to so rows that
+        don't match are never fetched. The SQL only applies going to the to
+        table. A bidirectional relationship follows all the way back. E.g.
+        >>> relationship = From('Customer', 'id').to(
+        ...         'Order', 'customer_id').where('created > %s', '2014-01-01')
+        >>> relationship.predicate
+        ('created > %s', ('2014-01-01',))
+        '''
+        self.predicate = (sql, args)
+        return self
+
     def create_callbacks(self):
         callbacks = []
-        def create_callback(from_columns, to_table, to_columns):
+        def create_callback(from_columns, to_table, to_columns, predicate):
             def callback(row):
                 col_pairs = zip(from_columns, to_columns)
                 target = [(to_col, row[src_col]) 
                           for (src_col, to_col) in col_pairs]
-                return (to_table, target)
+                return (to_table, target, predicate)
             return callback
 
         callback = create_callback(self.from_columns, 
-                                   self.to_table, self.to_columns)
+                                   self.to_table, self.to_columns,
+                                   self.predicate)
         callbacks.append((self.from_table, callback))
         
         if BIDIRECTIONAL in self.options:
             callback = create_callback(self.to_columns, 
-                                       self.from_table, self.from_columns)
+                                       self.from_table, self.from_columns,
+                                       None)
             callbacks.append((self.to_table, callback))
 
         return callbacks
 
+    def edges(self):
+        '''Gets the links this relationship follows as a list of:
+            (from_table, from_columns, to_table, to_columns, predicate)'''
+        edges = [(self.from_table, tuple(self.from_columns),
+                  self.to_table, tuple(self.to_columns), self.predicate)]
+        if BIDIRECTIONAL in self.options:
+            edges.append((self.to_table, tuple(self.to_columns),
+                           self.from_table, tuple(self.from_columns), None))
+        return edges
+
     def __str__(self):
         return "%s %s -> %s %s [%s]"%(
                 self.from_table, self.from_columns,
@@ -131,6 +272,503 @@ def From(table, *columns):
     """
     return Relationship(table, columns)
 
+def split_secondary_indexes(create_table):
+    """Splits the output of SHOW CREATE TABLE in to the table without its
+    secondary indexes and foreign keys, and a list of the definitions left
+    out. Loading rows in to a table is much quicker without indexes to update.
+    Indexes on AUTO_INCREMENT columns are kept as MySQL requires them. E.g.
+
+    >>> split_secondary_indexes('''CREATE TABLE `pet` (
+    ...   `id` int(11) NOT NULL AUTO_INCREMENT,
+    ...   `owner_id` int(11) NOT NULL,
+    ...   PRIMARY KEY (`id`),
+    ...   KEY `owner_id` (`owner_id`)
+    ... ) ENGINE=InnoDB''')
+    ('CREATE TABLE `pet` (\\n  `id` int(11) NOT NULL AUTO_INCREMENT,\\n  `owner_id` int(11) NOT NULL,\\n  PRIMARY KEY (`id`)\\n) ENGINE=InnoDB', ['KEY `owner_id` (`owner_id`)'])
+    """
+    lines = create_table.split('\n')
+    # Table options and partitioning follow the closing bracket
+    end = max([i for i, line in enumerate(lines) if line.startswith(')')])
+    definitions = [line.strip().rstrip(',') for line in lines[1:end]]
+    auto_increment = ['`%s`'%line.split('`')[1] for line in definitions
+                      if line.startswith('`') and 'AUTO_INCREMENT' in line]
+
+    kept = []
+    deferred = []
+    for definition in definitions:
+        secondary = definition.startswith(SECONDARY_INDEX_PREFIXES)
+        columns = definition[definition.find('(') + 1:]
+        if secondary and not columns.startswith(tuple(auto_increment)):
+            deferred.append(definition)
+        else:
+            kept.append(definition)
+    create_table = '%s\n  %s\n%s'%(
+            lines[0], ',\n  '.join(kept), '\n'.join(lines[end:]))
+
+    return (create_table, deferred)
+
+def strongly_connected_components(graph):
+    """Finds the strongly connected components of a graph given as:
+        { node: set(nodes it links to) }
+    Components are returned after every component they link to. E.g.
+
+    >>> strongly_connected_components({'a': set(['b']), 'b': set(['a']),
+    ...                                'c': set(['a'])})
+    [set(['a', 'b']), set(['c'])]
+    """
+    # Tarjan's algorithm
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    def visit(node):
+        index[node] = lowlink[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        for linked in graph.get(node, ()):
+            if linked not in index:
+                visit(linked)
+                lowlink[node] = min(lowlink[node], lowlink[linked])
+            elif linked in on_stack:
+                lowlink[node] = min(lowlink[node], index[linked])
+        if lowlink[node] == index[node]:
+            component = set()
+            while True:
+                linked = stack.pop()
+                on_stack.remove(linked)
+                component.add(linked)
+                if linked == node:
+                    break
+            components.append(component)
+
+    for node in sorted(graph.keys()):
+        if node not in index:
+            visit(node)
+    return components
+
+class LruCache(object):
+    """A small least recently used cache. Keeps hit and miss counts so that
+    the effectiveness of the cache can be checked. Several threads can be
+    transforming rows at once so the entries are guarded by a lock."""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+class ColumnTransform(object):
+    """Base class for deterministic column anonymizers. Transforms a whole
+    column of values at once. Each distinct value is only transformed once
+    while it stays in the cache. NULLs are left alone.
+
+    Subclasses implement transform(value)."""
+    def __init__(self, cache_size=TRANSFORM_CACHE_SIZE):
+        self.cache = LruCache(cache_size)
+
+    def __call__(self, values):
+        cache = self.cache
+        missing = object()
+        result = []
+        for value in values:
+            if value is None:
+                result.append(None)
+                continue
+            transformed = cache.get(value, missing)
+            if transformed is missing:
+                transformed = self.transform(value)
+                cache.put(value, transformed)
+            result.append(transformed)
+        return result
+
+    def transform(self, value):
+        raise NotImplementedError()
+
+def _digest(salt, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return hashlib.sha1('%s%s'%(salt, value)).hexdigest()
+
+class Hash(ColumnTransform):
+    """Replaces a value with a salted SHA1 hash of it. The first keep
+    characters of the original value are kept to make the output easier to
+    eyeball. E.g.
+
+    >>> Hash(keep=3, length=8)(['colin@mailinator.com'])
+    ['cold19c422f']
+    """
+    def __init__(self, salt='', keep=0, length=16, **kwargs):
+        ColumnTransform.__init__(self, **kwargs)
+        self.salt = salt
+        self.keep = keep
+        self.length = length
+
+    def transform(self, value):
+        if not isinstance(value, basestring):
+            value = str(value)
+        return value[:self.keep] + _digest(self.salt, value)[:self.length]
+
+class Mask(ColumnTransform):
+    """Replaces all but the first keep characters of a value with char. E.g.
+
+    >>> Mask(keep=2)(['Bob'])
+    ['Bo*']
+    """
+    def __init__(self, keep=0, char='*', **kwargs):
+        ColumnTransform.__init__(self, **kwargs)
+        self.keep = keep
+        self.char = char
+
+    def transform(self, value):
+        if not isinstance(value, basestring):
+            value = str(value)
+        return value[:self.keep] + self.char * max(0, len(value) - self.keep)
+
+class Fake(ColumnTransform):
+    """Replaces a value with one of the given choices. The same input value
+    always gets the same choice. E.g.
+
+    >>> Fake(['Alice', 'Bob', 'Carol'])(['Colin', 'Colin'])
+    ['Carol', 'Carol']
+    """
+    def __init__(self, choices, salt='', **kwargs):
+        ColumnTransform.__init__(self, **kwargs)
+        self.choices = list(choices)
+        self.salt = salt
+
+    def transform(self, value):
+        index = int(_digest(self.salt, value)[:8], 16) % len(self.choices)
+        return self.choices[index]
+
+class Anonymize(object):
+    """A batch callback that applies column transforms to a batch. Usage:
+
+    >>> batch_callbacks = {
+    ...     'Customer': Anonymize(email=Hash(keep=3), name=Mask(keep=1)),
+    ... }
+    """
+    def __init__(self, transforms={}, **more_transforms):
+        self.transforms = dict(transforms)
+        self.transforms.update(more_transforms)
+
+    def __call__(self, columns):
+        return dict([(col, transform(columns[col]))
+                     for col, transform in self.transforms.iteritems()])
+
+class BufferedWriter(object):
+    """Collects output for a chunk file in a fixed size buffer. Once the
+    buffer is full it is handed to the file in one go. This keeps the memory
+    used per batch bounded however many rows the batch has.
+
+    Output is encoded as UTF-8 as it is written so tell() is exact. If given
+    a manifest file, each INSERT written is noted in it as a line of JSON."""
+    def __init__(self, f, buffer_size=None, manifest=None):
+        self.file = f
+        self.buffer_size = buffer_size or OUTPUT_BUFFER_SIZE
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.peak_buffered = 0
+        self.lock = threading.Lock()
+        self.manifest = manifest
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.peak_buffered = max(self.peak_buffered, self.buffered)
+        self.file.write(''.join(self.buffer))
+        self.written += self.buffered
+        self.buffer = []
+        self.buffered = 0
+
+    def tell(self):
+        return self.written + self.buffered
+
+    def add_to_manifest(self, table_name, offset, rows, pk_min, pk_max):
+        '''Notes an INSERT written from offset up to the current position'''
+        if self.manifest is None:
+            return
+        self.manifest.write(json.dumps({
+            'table': table_name,
+            'offset': offset,
+            'length': self.tell() - offset,
+            'rows': rows,
+            'pk_min': pk_min,
+            'pk_max': pk_max,
+        }, default=_json_default) + '\n')
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self.manifest is not None:
+            self.manifest.close()
+
+class ChunkManifest(object):
+    """Reads the manifest written alongside a chunk file. Each INSERT in the
+    chunk has an entry giving its table, where it is in the file, how many
+    rows it has and the smallest and largest primary key in it. This means a
+    table, or part of one, can be restored without reading the whole chunk.
+    E.g.
+
+        manifest = ChunkManifest('dump.sql.0')
+        for statement in manifest.statements('Order', (100,), (200,)):
+            cursor.execute(statement)
+
+    Keys are given in the order of the primary key columns.
+    """
+    def __init__(self, chunk_file):
+        self.chunk_file = chunk_file
+        f = open('%s.manifest'%chunk_file, 'r')
+        self.entries = [json.loads(line) for line in f]
+        f.close()
+
+    def tables(self):
+        return sorted(set([entry['table'] for entry in self.entries]))
+
+    def find(self, table_name, low=None, high=None):
+        '''Gets the entries for the INSERTs into a table that may have keys
+        between low and high inclusive'''
+        if low is not None:
+            low = list(low)
+        if high is not None:
+            high = list(high)
+        return [entry for entry in self.entries
+                if entry['table'] == table_name and
+                (low is None or entry['pk_max'] >= low) and
+                (high is None or entry['pk_min'] <= high)]
+
+    def statements(self, table_name, low=None, high=None):
+        '''Reads the INSERTs into a table that may have keys between low and
+        high inclusive. Statements are read whole so can have rows with keys
+        either side of the range'''
+        f = open(self.chunk_file, 'rb')
+        try:
+            for entry in self.find(table_name, low, high):
+                f.seek(entry['offset'])
+                yield f.read(entry['length']).decode('utf8')
+        finally:
+            f.close()
+
+class DatabaseWriter(object):
+    """Writes rows straight into a target database rather than into a chunk
+    file. Each batch of rows is sent as a single parameterised executemany
+    insert and committed on its own.
+
+    tell() reports the number of rows written so that a set of these can be
+    balanced in the same way as chunk files.
+    """
+    def __init__(self, connection_spec):
+        self.db = MySQLdb.connect(charset='utf8', **connection_spec)
+        self.cursor = self.db.cursor()
+        self.cursor.execute('SET FOREIGN_KEY_CHECKS=0')
+        self.rows_written = 0
+        self.lock = threading.Lock()
+
+    def tell(self):
+        return self.rows_written
+
+    def insert(self, table_name, col_names, rows, allow_duplicates):
+        sql = 'INSERT %s INTO `%s`(%s) VALUES(%s)'%(
+            "IGNORE" if allow_duplicates else "",
+            table_name,
+            ",".join(["`%s`"%col for col in col_names]),
+            ",".join(["%s"] * len(col_names)))
+        try:
+            self.cursor.executemany(sql, rows)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        self.rows_written += len(rows)
+
+    def write(self, sql):
+        if not sql.strip():
+            return
+        self.cursor.execute(sql)
+        while self.cursor.nextset():
+            pass
+        self.db.commit()
+
+    def close(self):
+        self.cursor.execute('SET FOREIGN_KEY_CHECKS=1')
+        self.cursor.close()
+        self.db.close()
+
+class Estimate(object):
+    """The projected size of a dump. tables is of the form:
+        { table_name: { 'rows': rows, 'bytes': bytes, 'queries': queries } }
+    """
+    def __init__(self, tables):
+        self.tables = tables
+        self.rows = sum([table['rows'] for table in tables.values()])
+        self.bytes = sum([table['bytes'] for table in tables.values()])
+        self.queries = sum([table['queries'] for table in tables.values()])
+        self.chunks = max(1, int(math.ceil(
+                float(self.bytes) / ESTIMATE_CHUNK_BYTES)))
+
+    def __str__(self):
+        lines = ['%-30s %12s %15s %10s'%('Table', 'Rows', 'Bytes', 'Queries')]
+        for name in sorted(self.tables.keys()):
+            table = self.tables[name]
+            lines.append('%-30s %12d %15d %10d'%(
+                name, table['rows'], table['bytes'], table['queries']))
+        lines.append('%-30s %12d %15d %10d'%(
+            'Total', self.rows, self.bytes, self.queries))
+        lines.append('Recommended --chunks: %d'%self.chunks)
+        return '\n'.join(lines)
+
+# The dumper in an encoding process. It's inherited when the process is
+# forked so callbacks don't need to be pickled
+_encoding_dumper = None
+
+def _start_encoding(dumper):
+    global _encoding_dumper
+    _encoding_dumper = dumper
+
+def _encode_batch(task):
+    '''Transforms and serialises a batch of rows in an encoding process.
+    The parent sends the table's schema along as the process has no
+    connection to look it up with'''
+    (table_name, schema, output, rows) = task
+    dumper = _encoding_dumper
+    dumper.cached_schemas[table_name] = schema
+    dumper.cached_outputs[table_name] = output
+    summary = {}
+    sql = ''.join(dumper._encode_rows(
+        table_name, dumper._transform_rows(table_name, rows), summary))
+    return (sql, summary)
+
+class Progress(object):
+    """Reports how far through a dump is every interval seconds. Reports go
+    to stream, or to status_file if given. The status file is replaced each
+    time so it always holds the latest report. Only counters the dump keeps
+    anyway are read so reporting is cheap enough to leave on.
+
+    The ETA is worked out from expected_rows, the most rows the dump can
+    have. This is the number of rows information_schema.TABLES gives for the
+    tables being dumped so is only as good as MySQL's statistics. A partial
+    dump usually finishes sooner.
+    """
+    def __init__(self, dumper, expected_rows=None, interval=PROGRESS_INTERVAL,
+                 stream=stderr, status_file=None):
+        self.dumper = dumper
+        self.expected_rows = expected_rows
+        self.interval = interval
+        self.stream = stream
+        self.status_file = status_file
+        self.started = time.time()
+        # The time of the last report and the counts at that time, to work
+        # out rates from
+        self.last = (self.started, {}, {})
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stops reporting, after a final report'''
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.write()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        report = self.report()
+        if not self.status_file:
+            self.stream.write(report + '\n\n')
+            return
+        # Written alongside then moved in to place, so anything watching the
+        # file never sees half a report
+        f = open('%s.tmp'%self.status_file, 'w')
+        f.write(report + '\n')
+        f.close()
+        os.rename('%s.tmp'%self.status_file, self.status_file)
+
+    def _writers(self):
+        '''Gets each writer with a name for it, as (name, writer)'''
+        dumper = self.dumper
+        if dumper.ordered:
+            with dumper._writers_lock:
+                return sorted(dumper.table_writers.items())
+        if dumper.target:
+            return [('target %d'%i, writer)
+                    for i, writer in enumerate(dumper.writers)]
+        return [('%s.%d'%(dumper.output_prefix, i), writer)
+                for i, writer in enumerate(dumper.writers)]
+
+    def report(self):
+        dumper = self.dumper
+        now = time.time()
+        with dumper._stats_lock:
+            rows = dict([(name, dumper.fetched[name] - dumper.duplicates[name])
+                         for name in dumper.fetched.keys()])
+            pending = dict(dumper.pending_keys)
+        sizes = dict([(name, writer.tell())
+                      for (name, writer) in self._writers()])
+        (last_time, last_rows, last_sizes) = self.last
+        self.last = (now, rows, sizes)
+        since_last = max(now - last_time, 0.001)
+        elapsed = max(now - self.started, 0.001)
+
+        total = sum(rows.values())
+        eta = '?'
+        if self.expected_rows and total and total < self.expected_rows:
+            seconds = (self.expected_rows - total) / (total / elapsed)
+            eta = str(timedelta(seconds=int(seconds)))
+        lines = ['%s elapsed, %d rows dumped of at most %s, ETA %s'%(
+            timedelta(seconds=int(elapsed)), total,
+            self.expected_rows if self.expected_rows is not None else '?',
+            eta)]
+
+        lines.append('%-30s %12s %12s %10s'%(
+            'Table', 'Rows', 'Pending', 'Rows/s'))
+        for name in sorted(set(rows.keys()) | set(pending.keys())):
+            lines.append('%-30s %12d %12d %10.1f'%(
+                name, rows.get(name, 0), max(0, pending.get(name, 0)),
+                (rows.get(name, 0) - last_rows.get(name, 0)) / since_last))
+
+        # Databases are written to a row at a time rather than in bytes
+        unit = 'Rows/s' if dumper.target else 'MB/s'
+        scale = 1 if dumper.target else 1024 * 1024
+        lines.append('%-30s %12s'%('Output', unit))
+        for name in sorted(sizes.keys()):
+            lines.append('%-30s %12.2f'%(name, float(
+                sizes[name] - last_sizes.get(name, 0)) / scale / since_last))
+        return '\n'.join(lines)
+
 class Dumper(object):
     def __init__(
             self,
@@ -147,7 +785,22 @@ class Dumper(object):
             start_args=[],
             end_sql='',
             chunks=1,
-            output_prefix='dump.sql'
+            output_prefix='dump.sql',
+            target=None,
+            batch_callbacks={},
+            starts=None,
+            threads=START_THREADS,
+            shards=None,
+            shard_router=None,
+            ordered=False,
+            create_tables=False,
+            rounds=False,
+            joins=False,
+            prepared=False,
+            probe=False,
+            progress=False,
+            status_file=None,
+            processes=0
             ):
         self.relationships = relationships
         self.pks = pks
@@ -163,46 +816,372 @@ class Dumper(object):
         self.end_sql = end_sql
         self.chunks = chunks
         self.output_prefix = output_prefix
+        # Connection arguments for a target database. If given, rows are
+        # copied straight into it instead of being written to chunk files
+        self.target = target
+        self.batch_callbacks = batch_callbacks
+        # A list of (table, where, args) to start from. These are crawled
+        # concurrently by up to threads threads
+        self.starts = starts or [(start_table, start_where, start_args)]
+        self.threads = threads
+        # Connection arguments for each shard, which override the source
+        # database details above. The router is a function giving the shard
+        # a key is on
+
+        self.shards = shards
+        self.shard_router = shard_router
+        # Whether to write tables out in an order that can be loaded with
+        # foreign key checks enabled
+        self.ordered = ordered
+        # Whether to include the CREATE TABLE for each table. Secondary
+        # indexes are left out and added once the rows are loaded
+        self.create_tables = create_tables
+        # Whether to follow keys in rounds, a table at a time, instead of
+        # straight after the query that found them. Keys for a table build up
+        # between rounds so they are fetched in fewer, bigger queries
+        self.rounds = rounds
+        # Whether to run follow queries as server side prepared statements
+        self.prepared = prepared
+        # Whether to fetch just the primary keys for a follow first, when
+        # most of the rows it finds have already been dumped
+        self.probe = probe
+        # Whether to report progress to stderr, or to a status file
+        self.progress = progress
+        self.status_file = status_file
+        # How many processes to transform and serialise rows in. With none
+        # this is done by the threads crawling
+        self.processes = processes
+        if ordered and target:
+            raise Exception(
+                    'Ordered output cannot be used when copying to a database')
+        if processes and target:
+            raise Exception(
+                    'Rows are not serialised when copying to a database so '
+                    'cannot be serialised in other processes')
+        if joins and shards:
+            raise Exception(
+                    'Joins cannot be used when dumping from shards as the '
+                    'rows joined to may be on another shard')
+        if shard_router is not None and not callable(shard_router):
+            raise Exception(
+                    'shard_router must be a function giving the shard for '
+                    'a key')
 
         self.cached_schemas = {}
+        # { table_name: columns dumped, or None if all fetched are dumped }
+        self.cached_outputs = {}
+
+        # Each thread crawling the database has its own connection. The keys
+        # seen and the writers are shared between them
+        self._local = threading.local()
+        self._seen_lock = threading.Lock()
+        self._writers_lock = threading.Lock()
+        self._encoded_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # { table_name: number of SELECTs run }
+        self.queries = defaultdict(int)
+        # { table_name: number of rows fetched }
+        self.fetched = defaultdict(int)
+        # { table_name: number of rows fetched that had already been dumped }
+        self.duplicates = defaultdict(int)
+        # How many rows found by following something other than the primary
+        # key had been dumped before, as:
+        #   { table_name: [rows, rows already dumped] }
+        self.follow_duplicates = defaultdict(lambda : [0, 0])
+        # { table_name: number of keys found that are yet to be followed }
+        self.pending_keys = defaultdict(int)
+
+        # The static links between tables, stored as:
+        #   { from_table: [(from_columns, to_table, to_columns, predicate)] }
+        self.edges = defaultdict(list)
+        for relationship in relationships:
+            for (from_table, from_columns, to_table, to_columns, predicate) \
+                    in relationship.edges():
+                self.edges[from_table].append(
+                        (from_columns, to_table, to_columns, predicate))
 
-    def _get_writer(self):
+        # The order tables are visited in when following keys in rounds.
+        # Tables that can lead back to each other are visited together, and
+        # before the tables they lead on to
+        links = dict([(name, set()) for name in pks.keys()])
+        for from_table, to_links in self.edges.items():
+            for (_, to_table, _, _) in to_links:
+                links.setdefault(from_table, set()).add(to_table)
+        self.schedule = list(reversed(strongly_connected_components(links)))
+
+        # The tables fetched in the same query as each table, if joining
+        self.joins = {}
+        if joins:
+            for table_name in pks.keys():
+                tree = self._find_joins(table_name)
+                if tree:
+                    self.joins[table_name] = tree
+
+    def _find_joins(self, table_name):
+        '''Finds the tables that can be joined on to a table. Every link to
+        the primary key of another table is joined, and then the links from
+        those tables, for up to JOIN_HOPS hops. As each of these links finds
+        at most one row, joining them doesn't add rows. Gives a list of:
+            (from_table, from_columns, to_table, to_columns)
+        with each table after the table it is joined from. Tables without a
+        key cache are left out as the key cache is what stops their rows
+        being fetched again by the usual follow. So are links with a where
+        clause, which can't be applied to a join without knowing which table
+        its columns are in'''
+        joins = []
+        tables = set([table_name])
+        level = [table_name]
+        for _ in xrange(JOIN_HOPS):
+            next_level = []
+            for current in level:
+                for (from_columns, to_table, to_columns, predicate) in \
+                        self.edges[current]:
+                    if to_table in tables or predicate is not None or \
+                            not self._is_pk(to_table, to_columns) or \
+                            NO_KEY_CACHE in self.pks[to_table].options:
+                        continue
+                    joins.append((current, from_columns, to_table, to_columns))
+                    tables.add(to_table)
+                    next_level.append(to_table)
+            level = next_level
+        return joins
+
+    def _get_writer(self, table_name=None):
         '''Gets the writer with the least data in it. This helps keep files
         balanced if using multiple chunks for output'''
+        if self.ordered:
+            return self._get_table_writer(table_name)
         writers_with_size = []
         for writer in self.writers:
             writers_with_size.append((writer, writer.tell()))
         return sorted(writers_with_size, key=lambda t: t[1])[0][0]
 
+    def _get_table_writer(self, table_name):
+        '''Gets the file rows for a table are kept in until the dump is
+        finished and they can be written out in order'''
+        with self._writers_lock:
+            writer = self.table_writers.get(table_name)
+            if writer is None:
+                writer = BufferedWriter(tempfile.TemporaryFile(),
+                                        manifest=tempfile.TemporaryFile())
+                self.table_writers[table_name] = writer
+                self.writers.append(writer)
+            return writer
+
     def _create_writers(self):
         self.writers = []
+        if self.ordered:
+            # Writers are created for each table as they are needed
+            self.table_writers = {}
+            return
+
+        if self.target:
+            # One connection per chunk gives a small pool of writers
+            for chunk in range(self.chunks):
+                self.writers.append(DatabaseWriter(self.target))
+            return
+
         for chunk in range(self.chunks):
-            writer = open("%s.%d"%(self.output_prefix, chunk), 'w')
-            writer = codecs.getwriter('utf8')(writer)
+            writer = self._open_chunk("%s.%d"%(self.output_prefix, chunk))
             self.writers.append(writer)
             writer.write('SET FOREIGN_KEY_CHECKS=0;\n')
 
+    def _open_chunk(self, file_name):
+        '''Opens a chunk file along with its manifest, which is named:
+            <chunk file>.manifest'''
+        return BufferedWriter(open(file_name, 'wb'),
+                              manifest=open('%s.manifest'%file_name, 'wb'))
+
+    def _get_db(self):
+        return self._local.db
+
+    def _set_db(self, db):
+        self._local.db = db
+
+    def _get_cursor(self):
+        return self._local.cursor
+
+    def _set_cursor(self, cursor):
+        self._local.cursor = cursor
+
+    db = property(_get_db, _set_db)
+    cursor = property(_get_cursor, _set_cursor)
+
     def _connect_to_db(self):
-        self.db = MySQLdb.connect(
-                user=self.db_username,
-                passwd=self.db_password,
-                db=self.db_name,
-                host=self.db_address,
-                port=self.db_port,
-                charset='utf8',
-                cursorclass=cursors.SSCursor)
-        self.cursor = self.db.cursor()
-        self.cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
-        self.cursor.execute('START TRANSACTION')
+        '''Connects to the source database, or to every shard if dumping from
+        shards. The first connection is used for anything that isn't
+        fetching rows, such as reading table schemas'''
+        source = {
+            'user': self.db_username,
+            'passwd': self.db_password,
+            'db': self.db_name,
+            'host': self.db_address,
+            'port': self.db_port,
+        }
+        connections = []
+        for shard in self.shards or [{}]:
+            spec = dict(source)
+            spec.update(shard)
+            db = MySQLdb.connect(
+                    charset='utf8', cursorclass=cursors.SSCursor, **spec)
+            cursor = db.cursor()
+            cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('START TRANSACTION')
+            connections.append((db, cursor))
+        self._local.connections = connections
+        (self.db, self.cursor) = connections[0]
+        # The statements prepared on each connection, as:
+        #   { sql: statement name }
+        self._local.statements = [{} for _ in connections]
 
     def _close_db(self):
-        self.cursor.execute('ROLLBACK')
-        self.cursor.close()
-        self.db.close()
+        for (db, cursor) in self._local.connections:
+            cursor.execute('ROLLBACK')
+            cursor.close()
+            db.close()
+
+    def estimate(self):
+        '''Estimates how big the dump will be without fetching any rows.
+        The number of rows matched by the start query comes from EXPLAIN.
+        Each link is then followed using the index statistics of the table
+        at the other end to work out how many rows each key will pull in'''
+        self._connect_to_db()
+        try:
+            table_stats = self._get_table_statistics()
+            start_rows = defaultdict(float)
+            for (table_name, where, where_args) in self.starts:
+                start_rows[table_name] += self._explain_rows(
+                        table_name, where, where_args)
+        finally:
+            self._close_db()
+
+        def rows_per_key(table_name, columns):
+            (table_rows, _, cardinalities) = table_stats.get(
+                    table_name, (0, 0, {}))
+            cardinality = cardinalities.get(frozenset(columns))
+            if not cardinality:
+                # No index to go on. Assume each key finds a single row
+                return 1.0
+            return max(1.0, float(table_rows) / cardinality)
+
+        def room_in(table_name, rows):
+            table_rows = table_stats.get(table_name, (0, 0, {}))[0]
+            if not table_rows:
+                # Statistics can be missing or stale. Don't trust an empty
+                # table
+                return float('inf')
+            return max(0.0, table_rows - rows)
+
+        rows = defaultdict(float)
+        queries = defaultdict(float)
+        for (table_name, _, _) in self.starts:
+            queries[table_name] += 1
+        rows.update(start_rows)
+
+        # Rows found in one round lead to keys to follow in the next. Each
+        # table can't give more rows than it has so cycles die out
+        frontier = dict(start_rows)
+        for _ in xrange(ESTIMATE_ROUNDS):
+            found = defaultdict(float)
+            for table_name, new_rows in frontier.iteritems():
+                for (_, to_table, to_columns, _) in self.edges[table_name]:
+                    if to_table not in self.pks:
+                        continue
+                    batch_size = self.pks[to_table].batch_size
+                    queries[to_table] += math.ceil(new_rows / batch_size)
+                    found[to_table] += min(
+                            new_rows * rows_per_key(to_table, to_columns),
+                            room_in(to_table, rows[to_table] + found[to_table]))
+            frontier = {}
+            for table_name, new_rows in found.iteritems():
+                rows[table_name] += new_rows
+                if new_rows >= 1:
+                    frontier[table_name] = new_rows
+            if not frontier:
+                break
+
+        tables = {}
+        for table_name in rows.keys():
+            avg_row_length = table_stats.get(table_name, (0, 0, {}))[1]
+            tables[table_name] = {
+                'rows': int(round(rows[table_name])),
+                'bytes': int(round(rows[table_name] * avg_row_length)),
+                'queries': int(queries[table_name]),
+            }
+        return Estimate(tables)
+
+    def _count_rows(self):
+        '''Adds up the rows in the tables being dumped on every shard. Only
+        the row counts MySQL keeps in information_schema.TABLES are read so
+        this is quick however big the schema is'''
+        self._connect_to_db()
+        try:
+            rows = 0
+            for (_, cursor) in self._local.connections:
+                cursor.execute(
+                        'SELECT TABLE_NAME, TABLE_ROWS '
+                        'FROM information_schema.TABLES '
+                        'WHERE TABLE_SCHEMA = DATABASE()')
+                for (table_name, table_rows) in cursor.fetchall():
+                    if table_name in self.pks:
+                        rows += table_rows or 0
+        finally:
+            self._close_db()
+        return rows
+
+    def _get_table_statistics(self):
+
+        '''Gets the row counts, average row lengths and index cardinalities
+        for every table in the database as:
+            { table_name: (rows, avg_row_length, { columns: cardinality }) }
+        '''
+        self.cursor.execute(
+                'SELECT TABLE_NAME, TABLE_ROWS, AVG_ROW_LENGTH '
+                'FROM information_schema.TABLES '
+                'WHERE TABLE_SCHEMA = DATABASE()')
+        stats = {}
+        for (table_name, table_rows, avg_row_length) in self.cursor.fetchall():
+            stats[table_name] = (table_rows or 0, avg_row_length or 0, {})
+
+        # The cardinality of each prefix of an index is the number of distinct
+        # values for those columns
+        self.cursor.execute(
+                'SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME, CARDINALITY '
+                'FROM information_schema.STATISTICS '
+                'WHERE TABLE_SCHEMA = DATABASE() '
+                'ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX')
+        prefixes = {}
+        for (table_name, index_name, column_name, cardinality) in \
+                self.cursor.fetchall():
+            key = (table_name, index_name)
+            columns = prefixes.get(key, frozenset()) | set([column_name])
+            prefixes[key] = columns
+            if table_name in stats and cardinality:
+                stats[table_name][2][columns] = cardinality
+        return stats
+
+    def _explain_rows(self, table_name, where, where_args):
+        self.cursor.execute(
+                "EXPLAIN SELECT * FROM `%s` WHERE %s"%(table_name, where),
+                where_args)
+        col_names = [col[0].lower() for col in self.cursor.description]
+        result = self.cursor.fetchall()
+        if not result:
+            return 0
+        row = dict(zip(col_names, result[0]))
+        rows = float(row.get('rows') or 0)
+        if row.get('filtered') is not None:
+            rows = rows * float(row['filtered']) / 100
+        return rows
 
     def _close_writers(self):
+        if self.ordered:
+            self._write_ordered()
+            return
+
         for writer in self.writers:
-            writer.write('SET FOREIGN_KEY_CHECKS=1;\n')
+            if not self.target:
+                writer.write('SET FOREIGN_KEY_CHECKS=1;\n')
             writer.close()
 
     def _create_callbacks(self):
@@ -217,65 +1196,545 @@ class Dumper(object):
 
     def go(self):
         self.pks_seen = dict([(name, set()) for name in self.pks.keys()])
+        # Primary keys being fetched that haven't been seen yet. Another
+        # thread following them as well can leave them to the first
+        self.pks_requested = dict([(name, set()) for name in self.pks.keys()])
         
         self._create_writers()
         self._create_callbacks()
+        self.encoder = None
+        if self.processes:
+            # Forked before any other threads are started
+            self.encoder = Pool(self.processes, _start_encoding, (self,))
+            self.encoded = deque()
+        if self.shards:
+            # Each crawling thread can be streaming from every shard at once
+            self.shard_pool = ThreadPool(len(self.shards) * self.threads)
+        if self.create_tables:
+            self._connect_to_db()
+            definitions = self._get_table_definitions()
+            self._close_db()
+            self._write_create_tables(definitions)
 
-        self._connect_to_db()
-        self._get_table(self.start_table, where=self.start_where, where_args=self.start_args)
-        self._close_db()
+        progress = None
+        if self.progress or self.status_file:
+            progress = Progress(self, self._count_rows(),
+                                status_file=self.status_file)
+            progress.start()
+        try:
+            if len(self.starts) == 1:
+                self._connect_to_db()
+                (table_name, where, where_args) = self.starts[0]
+                self._crawl(table_name, where, where_args)
+                self._close_db()
+            else:
+                self._crawl_concurrently()
+        finally:
+            if self.encoder:
+                self._write_encoded(0)
+                self.encoder.close()
+                self.encoder.join()
+            if progress:
+                progress.stop()
 
-        self._get_writer().write(self.end_sql)
+        if self.shards:
+            self.shard_pool.close()
+        if self.create_tables:
+            self._write_indexes(definitions)
+        if not self.ordered:
+            self._get_writer().write(self.end_sql)
 
         self._close_writers()
+        self._report_memory()
+        events.emit(LOG_INFO, 'queries',
+                total=sum(self.queries.values()), tables=dict(self.queries),
+                fetched=sum(self.fetched.values()),
+                duplicates=sum(self.duplicates.values()))
+
+    def _crawl(self, table_name, where, where_args):
+        '''Dumps the rows matching a start point and everything they lead
+        to'''
+        if not self.rounds:
+            self._get_table(table_name, [(None, where, where_args)])
+            return
+
+        self._local.pending = defaultdict(lambda : defaultdict(set))
+        self._get_table(table_name, [(None, where, where_args)])
+        pending = self._local.pending
+        # Custom relationships aren't in the schedule so can find keys for
+        # tables already visited. Rounds carry on until nothing is left
+        while pending:
+            unknown = [name for name in pending.keys() if name not in self.pks]
+            if unknown:
+                raise Exception('PK not created for %s'%unknown[0])
+            for component in self.schedule:
+                # Tables in a cycle keep finding keys for each other. Go round
+                # them until they run dry before moving on
+                while True:
+                    table_names = [name for name in sorted(component)
+                                   if name in pending]
+                    if not table_names:
+                        break
+                    for name in table_names:
+                        self._do_follows({name: pending.pop(name)})
+
+    def _defer_follows(self, to_follow):
+        '''Keeps keys to follow until their table's turn in the round'''
+        pending = self._local.pending
+        for table, follow_sets in to_follow.iteritems():
+            for key, value_sets in follow_sets.iteritems():
+                keys = pending[table][key]
+                waiting = len(keys)
+                keys.update(value_sets)
+                self._add_pending(table, len(keys) - waiting)
+
+    def _add_pending(self, table_name, keys):
+        with self._stats_lock:
+            self.pending_keys[table_name] += keys
+
+    def _crawl_concurrently(self):
+        '''Crawls from each of the start points using a pool of threads.
+        Rows reachable from more than one start point are only fetched once
+        as all threads share the keys seen'''
+        starts = Queue.Queue()
+        for start in self.starts:
+            starts.put(start)
+        failures = []
+
+        def crawl():
+            try:
+                self._connect_to_db()
+                try:
+                    while True:
+                        try:
+                            (table_name, where, where_args) = starts.get_nowait()
+                        except Queue.Empty:
+                            return
+                        self._crawl(table_name, where, where_args)
+                finally:
+                    self._close_db()
+            except:
+                failures.append(sys.exc_info())
+
+        threads = [threading.Thread(target=crawl)
+                   for _ in xrange(min(self.threads, len(self.starts)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            (exc_type, exc_value, exc_traceback) = failures[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def _get_table_definitions(self):
+        '''Gets the CREATE TABLE for every table that can be dumped as:
+            { table_name: (create_table, [secondary indexes]) }'''
+        definitions = {}
+        for table_name in self.pks.keys():
+            self.cursor.execute('SHOW CREATE TABLE `%s`'%table_name)
+            (_, create_table) = self.cursor.fetchall()[0]
+            definitions[table_name] = split_secondary_indexes(create_table)
+        return definitions
+
+    def _write_create_tables(self, definitions):
+        '''Creates the tables before any rows are written. When copying to a
+        database the tables are created there straight away, otherwise they
+        are written to <output prefix>.schema'''
+        statements = ['SET FOREIGN_KEY_CHECKS=0']
+        for table_name in sorted(definitions.keys()):
+            statements.append('DROP TABLE IF EXISTS `%s`'%table_name)
+            statements.append(definitions[table_name][0])
+        if not self.target:
+            # Connections to a target keep checks off until they are closed
+            statements.append('SET FOREIGN_KEY_CHECKS=1')
+        self._write_statements(statements, "%s.schema"%self.output_prefix)
+
+    def _write_indexes(self, definitions):
+        '''Adds the secondary indexes once all the rows are written. Each
+        table gets a single ALTER TABLE so it is only rebuilt once. The ALTERs
+        are spread over <output prefix>.indexes.<chunk>. These files don't
+        depend on each other so can be run at the same time'''
+        alters = []
+        for table_name in sorted(definitions.keys()):
+            indexes = definitions[table_name][1]
+            if indexes:
+                alters.append('ALTER TABLE `%s`\n  ADD %s'%(
+                    table_name, ',\n  ADD '.join(indexes)))
+
+        # Foreign keys are added without checking the rows already loaded.
+        # A partial dump can leave rows referring to rows that weren't dumped
+        if self.target:
+            self._write_statements(['SET FOREIGN_KEY_CHECKS=0'] + alters)
+            return
+        for chunk in xrange(min(self.chunks, len(alters))):
+            statements = ['SET FOREIGN_KEY_CHECKS=0']
+            statements.extend(alters[chunk::self.chunks])
+            self._write_statements(statements,
+                    "%s.indexes.%d"%(self.output_prefix, chunk))
+
+    def _write_statements(self, statements, file_name=None):
+        if self.target:
+            for statement in statements:
+                self.writers[0].write(statement)
+            return
+        writer = BufferedWriter(open(file_name, 'wb'))
+        for statement in statements:
+            writer.write('%s;\n'%statement)
+        writer.close()
+
+    def _is_pk(self, table_name, columns):
+        return table_name in self.pks and \
+                set(columns) == set(self.pks[table_name].columns)
+
+    def _get_dependencies(self, table_names):
+        '''Works out which tables have to be loaded before which. A link to
+        the primary key of a table is taken to be a foreign key, so the table
+        at the other end depends on it. Gives:
+            { table_name: set(tables it depends on) }'''
+        dependencies = dict([(name, set()) for name in table_names])
+        for from_table, links in self.edges.items():
+            for (from_columns, to_table, to_columns, _) in links:
+                if from_table not in dependencies or \
+                        to_table not in dependencies:
+                    continue
+                to_pk = self._is_pk(to_table, to_columns)
+                from_pk = self._is_pk(from_table, from_columns)
+                if to_pk and not from_pk:
+                    dependencies[from_table].add(to_table)
+                elif from_pk and not to_pk:
+                    dependencies[to_table].add(from_table)
+        return dependencies
+
+    def _write_ordered(self):
+        '''Writes the rows kept for each table out so that tables are loaded
+        after the tables they depend on. Tables are grouped in to layers that
+        depend only on earlier layers. The files for a layer are named:
+            <output prefix>.<layer>.<chunk>
+        Once a layer is loaded all the files in the next layer can be loaded
+        at the same time. Tables that depend on each other are loaded together
+        with foreign key checks turned off'''
+        dependencies = self._get_dependencies(self.table_writers.keys())
+        components = strongly_connected_components(dependencies)
+
+        component_of = {}
+        for i, component in enumerate(components):
+            for table_name in component:
+                component_of[table_name] = i
+
+        # Components come out with the components they depend on first
+        layers = defaultdict(list)
+        component_layers = []
+        for i, component in enumerate(components):
+            layer = 0
+            for table_name in component:
+                for dependency in dependencies[table_name]:
+                    if component_of[dependency] != i:
+                        layer = max(layer,
+                                component_layers[component_of[dependency]] + 1)
+            component_layers.append(layer)
+            layers[layer].append(component)
+
+        def size(component):
+            return sum([self.table_writers[name].tell() for name in component])
+
+        for layer in sorted(layers.keys()):
+            # Spread the layer over the chunks, biggest first, to keep the
+            # files in a layer about the same size
+            files = [[] for _ in xrange(min(self.chunks, len(layers[layer])))]
+            sizes = [0] * len(files)
+            for component in sorted(layers[layer], key=size, reverse=True):
+                smallest = sizes.index(min(sizes))
+                files[smallest].append(component)
+                sizes[smallest] += size(component)
+
+            for chunk, file_components in enumerate(files):
+                writer = self._open_chunk("%s.%d.%d"%(
+                    self.output_prefix, layer, chunk))
+                for component in file_components:
+                    table_names = sorted(component)
+                    cyclic = len(component) > 1 or \
+                            table_names[0] in dependencies[table_names[0]]
+                    if cyclic:
+                        writer.write('-- %s refer to each other\n'%(
+                            ', '.join(table_names)))
+                        writer.write('SET FOREIGN_KEY_CHECKS=0;\n')
+                    for table_name in table_names:
+                        self._copy_table(table_name, writer)
+                    if cyclic:
+                        writer.write('SET FOREIGN_KEY_CHECKS=1;\n')
+                writer.close()
+
+        if self.end_sql:
+            last_layer = max(layers.keys() or [-1])
+            writer = self._open_chunk("%s.%d.0"%(
+                self.output_prefix, last_layer + 1))
+            writer.write(self.end_sql)
+            writer.close()
+
+        for writer in self.table_writers.values():
+            writer.close()
+
+    def _copy_table(self, table_name, writer):
+        table_writer = self.table_writers[table_name]
+        table_writer.flush()
+        table_writer.file.seek(0)
+        start = writer.tell()
+        while True:
+            block = table_writer.file.read(OUTPUT_BUFFER_SIZE)
+            if not block:
+                break
+            writer.write(block)
+
+        # The table's INSERTs have moved so their offsets move with them
+        table_writer.manifest.seek(0)
+        for line in table_writer.manifest:
+            entry = json.loads(line)
+            entry['offset'] += start
+            writer.manifest.write(json.dumps(entry) + '\n')
+
+    def _report_memory(self):
+        '''Records the peak memory used by the dump. Watching this is the
+        safest way to decide whether batch sizes can be raised'''
+        # Ordered dumps only have writers for tables with rows in
+        self.peak_buffered = max([0] + [getattr(writer, 'peak_buffered', 0)
+                                        for writer in self.writers])
+
+        if resource:
+            # Linux reports this in kilobytes
+            self.peak_memory = resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss
+            events.emit(LOG_INFO, 'memory',
+                    peak_kb=self.peak_memory,
+                    peak_buffered=self.peak_buffered)
 
     def _get_schema(self, table_name):
         '''Gets the schema of the given table. Will call to the database to
-        get the schema if it hasn't been explored before'''
+        get the schema if it hasn't been explored before. This describes the
+        columns fetched, which can include columns needed to crawl that
+        aren't dumped'''
         if table_name not in self.cached_schemas:
             schema = get_schema(self.cursor, table_name)
-            safe_col_names = ["`%s`"%row[0] for row in schema]
-            unsafe_col_names = [row[0] for row in schema]
-            col_offsets = dict([(row[0], i) for i, row in enumerate(schema)])
+            all_col_names = [row[0] for row in schema]
+            (unsafe_col_names, output_col_names) = self._project_columns(
+                    table_name, all_col_names)
+            safe_col_names = ["`%s`"%col for col in unsafe_col_names]
+            col_offsets = dict([(col, i)
+                                for i, col in enumerate(unsafe_col_names)])
+            if output_col_names == unsafe_col_names:
+                self.cached_outputs[table_name] = None
+            else:
+                self.cached_outputs[table_name] = (
+                        ["`%s`"%col for col in output_col_names],
+                        output_col_names,
+                        [col_offsets[col] for col in output_col_names])
             self.cached_schemas[table_name] = (
                     safe_col_names,
                     unsafe_col_names,
                     col_offsets)
 
         return self.cached_schemas[table_name]
+
+    def _project_columns(self, table_name, col_names):
+        '''Works out which columns of a table to fetch and which to dump.
+        Gives (columns to fetch, columns to dump), in table order'''
+        pk = self.pks.get(table_name)
+        if pk is None:
+            return (col_names, col_names)
+
+        # Keys and links are fetched even if they aren't dumped
+        needed = set(pk.columns)
+        for (from_columns, _, _, _) in self.edges[table_name]:
+            needed.update(from_columns)
+
+        replaced = needed.intersection(pk.replacements.keys())
+        if replaced:
+            raise Exception('%s.%s is needed to crawl so cannot be replaced'%(
+                table_name, sorted(replaced)[0]))
+
+        output_col_names = [col for col in col_names
+                if (pk.included is None or col in pk.included) and
+                col not in pk.excluded]
+        fetch_col_names = [col for col in col_names
+                if col in output_col_names or col in needed]
+        return (fetch_col_names, output_col_names)
+
+    def _get_output(self, table_name):
+        '''Gets the columns that are dumped, if not all of those fetched, as
+        (safe column names, column names, offsets in the fetched row)'''
+        self._get_schema(table_name)
+        return self.cached_outputs[table_name]
+
+    def _get_select(self, table_name, alias=None, placeholder='%s'):
+        '''Gets what to SELECT for each column fetched. Replaced columns are
+        selected as their replacement so the real value never leaves the
+        database. Replacements are passed as arguments. Gives:
+            (columns, args)'''
+        (safe_col_names, unsafe_col_names, _) = self._get_schema(table_name)
+        replacements = {}
+        if table_name in self.pks:
+            replacements = self.pks[table_name].replacements
+        columns = []
+        args = []
+        for (safe_col, col) in zip(safe_col_names, unsafe_col_names):
+            if col in replacements:
+                columns.append('%s AS %s'%(placeholder, safe_col))
+                args.append(replacements[col])
+            elif alias:
+                columns.append('%s.%s'%(alias, safe_col))
+            else:
+                columns.append(safe_col)
+        return (columns, args)
        
     def _do_follows(self, to_follow):
-        debug('PKs seen: %s'%self.pks_seen)
-        debug('To follow: %s'%to_follow)
         for table, follow_sets in to_follow.iteritems():
+            # Keys are followed separately for each set of columns and for
+            # each predicate a relationship narrows the rows down by
             follow_sets_keys = list(follow_sets.keys())
-            for col_names in follow_sets_keys:
-                value_sets = follow_sets[col_names]
-                if col_names == tuple(self.pks[table].columns):
+            for (col_names, predicate) in follow_sets_keys:
+                value_sets = follow_sets[(col_names, predicate)]
+                by_pk = col_names == tuple(self.pks[table].columns)
+                if by_pk:
+                    # A key is reserved before it is fetched so threads
+                    # crawling overlapping rows only fetch it once. Keys
+                    # narrowed down by a predicate might not find their row
+                    # so aren't reserved
+                    reserve = predicate is None and \
+                            NO_KEY_CACHE not in self.pks[table].options
                     values = []
-                    for value_tuple in value_sets:
-                        if value_tuple not in self.pks_seen[table]:
-                            values.append(value_tuple)
+                    with self._seen_lock:
+                        seen = self.pks_seen[table]
+                        requested = self.pks_requested[table]
+                        for value_tuple in value_sets:
+                            if value_tuple not in seen and \
+                                    value_tuple not in requested:
+                                values.append(value_tuple)
+                                if reserve:
+                                    requested.add(value_tuple)
                 else:
-                    info('Not killing follows for %s %s'%(col_names, table))
+                    # Only keys on the primary key can be checked against the
+                    # keys already seen
                     values = list(value_sets)
+                probe = not by_pk and self._should_probe(table)
+                # Keys already seen don't need following
+                self._add_pending(table, len(values) - len(value_sets))
+                events.emit(LOG_DEBUG, 'keys_deduped',
+                        table=table, columns=col_names,
+                        keys=len(value_sets), unseen=len(values))
 
                 batch_size = self.pks[table].batch_size
+                placeholder = '%s'
+                if self.prepared:
+                    batch_size = min(batch_size, PREPARED_ARITIES[-1])
+                    placeholder = '?'
+
+                shard_batches = []
+                for (shard, values) in self._route(table, col_names, values):
+                    shard_batches.append(
+                            [(shard, values[i:i + batch_size])
+                             for i in xrange(0, len(values), batch_size)])
+                # Each query sends the next batch for every shard at once
+                for batches in izip_longest(*shard_batches):
+                    queries = []
+                    for (shard, values_to_follow) in filter(None, batches):
+                        self._add_pending(table, -len(values_to_follow))
+                        if self.prepared:
+                            # Only a few sizes of query are used so each is
+                            # only prepared once. The gap is filled with the
+                            # last key again, which finds no extra rows
+                            arity = min([a for a in PREPARED_ARITIES
+                                         if a >= len(values_to_follow)])
+                            values_to_follow += [values_to_follow[-1]] * (
+                                    arity - len(values_to_follow))
+                        clauses = []
+                        args = []
+                        clause = " AND ".join(
+                                ["%s = %s"%(col, placeholder)
+                                 for col in col_names])
+                        clauses = [clause] * len(values_to_follow)
+                        for value in values_to_follow:
+                            args += [val for val in value]
+                        where = " OR ".join(clauses)
+                        if predicate:
+                            (predicate_sql, predicate_args) = predicate
+                            if self.prepared:
+                                predicate_sql = predicate_sql.replace(
+                                        '%s', '?').replace('%%', '%')
+                            where = "(%s) AND (%s)"%(where, predicate_sql)
+                            args += list(predicate_args)
+                        queries.append((shard, where, args))
+                    if probe:
+                        self._probe(table, queries)
+                        continue
+                    counts = [0, 0]
+                    self._get_table(table, queries, self.prepared, counts)
+                    if not by_pk:
+                        self._note_follow_duplicates(table, *counts)
+                del(follow_sets[(col_names, predicate)])
+
+    def _should_probe(self, table_name):
+        '''Works out whether to fetch just the primary keys for a follow
+        first. This costs an extra query so is only worth it when most rows
+        found this way have already been dumped. Rows can't be checked
+        without the key cache'''
+        if not self.probe or NO_KEY_CACHE in self.pks[table_name].options:
+            return False
+        (rows, duplicates) = self.follow_duplicates[table_name]
+        return rows > 0 and duplicates >= rows * PROBE_DUPLICATE_RATIO
+
+    def _note_follow_duplicates(self, table_name, rows, duplicates):
+        with self._stats_lock:
+            counts = self.follow_duplicates[table_name]
+            counts[0] += rows
+            counts[1] += duplicates
+
+    def _probe(self, table_name, queries):
+        '''Fetches only the primary keys of the rows a follow finds. The rows
+        that haven't been dumped are then fetched in full by primary key.
+        Queries are given as in _get_table'''
+        pk_columns = tuple(self.pks[table_name].columns)
+        sql_queries = []
+        for (shard, where, where_args) in queries:
+            events.emit(LOG_INFO, 'probe',
+                    table=table_name, where=where, args=len(where_args),
+                    shard=shard)
+            sql = "SELECT %s FROM `%s` WHERE %s"%(
+                    ",".join(["`%s`"%col for col in pk_columns]),
+                    table_name,
+                    where)
+            sql_queries.append((shard, sql, where_args))
+        with self._stats_lock:
+            self.queries[table_name] += len(queries)
+
+        rows = 0
+        unseen = set()
+        for keys in self._fetch(table_name, sql_queries, self.prepared):
+            rows += len(keys)
+            with self._seen_lock:
+                seen = self.pks_seen[table_name]
+                unseen.update([tuple(key) for key in keys
+                               if tuple(key) not in seen])
+        self._note_follow_duplicates(table_name, rows, rows - len(unseen))
+        events.emit(LOG_DEBUG, 'probed',
+                table=table_name, rows=rows, unseen=len(unseen))
 
-                while len(values) > 0:
-                    values_to_follow = values[:batch_size]
-                    del(values[:batch_size])
-                    clauses = []
-                    args = []
-                    clause = " AND ".join(["%s = %%s"%col for col in col_names])
-                    clauses = [clause] * len(values_to_follow)
-                    for value in values_to_follow:
-                        args += [val for val in value]
-                    debug('Clauses to follow: %s'%clauses)
-                    info('Following %s with %s'%(table, values_to_follow))
-                    where = " OR ".join(clauses)
-                    self._get_table(table, where, args)
-                del(follow_sets[col_names])
+        if unseen:
+            self._add_pending(table_name, len(unseen))
+            # The keys have already been narrowed down by any predicate
+            self._do_follows({table_name: {(pk_columns, None): unseen}})
+
+    def _route(self, table_name, col_names, values):
+        '''Splits keys to follow by the shard they live on. Gives a list of:
+            (shard, values)
+        A shard of None means the keys could be on any shard'''
+        if not self.shards or not self.shard_router:
+            return [(None, values)]
+
+        routed = defaultdict(list)
+        for value in values:
+            shard = self.shard_router(table_name, dict(zip(col_names, value)))
+            routed[shard].append(value)
+        return routed.items()
 
     def _get_pk_value(self, table_name, row):
         (_, _, offsets) = self._get_schema(table_name)
@@ -284,93 +1743,410 @@ class Dumper(object):
 
     def is_row_seen(self, table_name, row):
         pk = self._get_pk_value(table_name, row)
-        if pk in self.pks_seen[table_name]:
-            debug('PK %s seen in %s'%(pk, table_name))
-            return True
-        else:
-            debug('PK %s not seen in %s'%(pk, table_name))
-            return False
+        seen = pk in self.pks_seen[table_name]
+        events.emit(LOG_DEBUG, 'row_seen', table=table_name, pk=pk, seen=seen)
+        return seen
 
     def add_row(self, table_name, row):
         pk = self._get_pk_value(table_name, row)
         if NO_KEY_CACHE in self.pks[table_name].options:
             return True
-        if pk in self.pks_seen[table_name]:
-            return False
-        self.pks_seen[table_name].add(pk)
+        with self._seen_lock:
+            if pk in self.pks_seen[table_name]:
+                return False
+            self.pks_seen[table_name].add(pk)
+            self.pks_requested[table_name].discard(pk)
         return True
 
-    def _remove_seen_rows(self, table_name, rows):
+    def _remove_seen_rows(self, table_name, rows, counts):
+        '''Drops rows that have already been dumped. The number of rows and
+        the number dropped are added to counts and to the dump's totals once
+        the batch has been read'''
         if table_name not in self.pks:
             raise Exception('PK not created for %s'%table_name)
-        rows = [row for row in rows if self.add_row(table_name, row)]
-        return rows
+        fetched = 0
+        duplicates = 0
+        for row in rows:
+            fetched += 1
+            if self.add_row(table_name, row):
+                yield row
+            else:
+                duplicates += 1
+        counts[0] += fetched
+        counts[1] += duplicates
+        # Counted for each batch so progress shows while a big query is read
+        with self._stats_lock:
+            self.fetched[table_name] += fetched
+            self.duplicates[table_name] += duplicates
 
     def _row_dict(self, row, col_offsets):
         return dict([(col, row[i]) for col, i in col_offsets.items()])
 
     def _calculate_follows(self, table_name, rows, to_follow):
-        (safe_col_names, unsafe_col_names, col_offsets) = \
-                self._get_schema(table_name)
-        for callback in self.relationships[table_name]:
-            for row in rows:
-                row = callback(self._row_dict(row, col_offsets))
-                if row is None:
-                    continue
+        '''Passes rows straight through, noting what needs to be followed
+        from each row on the way past'''
+        (_, _, col_offsets) = self._get_schema(table_name)
+        callbacks = self.relationships[table_name]
+        for row in rows:
+            if callbacks:
+                row_dict = self._row_dict(row, col_offsets)
+                for callback in callbacks:
+                    target = callback(row_dict)
+                    if target is None:
+                        continue
+
+                    target_name = target[0]
+                    keys = target[1]
+                    predicate = None
+                    if len(target) > 2:
+                        predicate = target[2]
 
-                target_name = row[0]
-                keys = row[1]
+                    (col_names, values) = zip(*keys)
+                    to_follow[target_name][(col_names, predicate)].add(values)
 
-                (col_names, values) = zip(*keys)
-                to_follow[target_name][col_names].add(values)
+            yield row
+
+    def _transform_rows(self, table_name, rows):
+        (_, unsafe_col_names, col_offsets) = self._get_schema(table_name)
+        callback = self.callbacks.get(table_name, None)
+        if callback:
+            rows = self._call_row_callback(
+                    callback, rows, unsafe_col_names, col_offsets)
+
+        # Batch callbacks are given the batch as columns:
+        #   { column_name: [value_1, value_2, ...] }
+        # and return only the columns they have changed
+        batch_callback = self.batch_callbacks.get(table_name, None)
+        if batch_callback:
+            columns = zip(*rows)
+            if not columns:
+                return []
+            changed = batch_callback(dict(zip(unsafe_col_names, columns)))
+            for col, values in changed.iteritems():
+                columns[col_offsets[col]] = values
+            rows = zip(*columns)
+        return rows
+
+    def _call_row_callback(self, callback, rows, col_names, col_offsets):
+        for row in rows:
+            row_dict = callback(self._row_dict(row, col_offsets))
+            yield [row_dict[col] for col in col_names]
 
     def _write_rows(self, table_name, rows):
-        (safe_col_names, unsafe_col_names, col_offsets) = \
-                self._get_schema(table_name)
+        if self.encoder:
+            # Reading the rows runs the stages before this one, so follows
+            # are still worked out here
+            rows = list(rows)
+            if rows:
+                self._send_to_encoder(table_name, rows)
+            return
+
+        (_, unsafe_col_names, _) = self._get_schema(table_name)
         allow_duplicates = ALLOW_DUPLICATES in self.pks[table_name].options
+        rows = self._transform_rows(table_name, rows)
 
-        result = self._get_writer()
-        result.write('INSERT %s INTO %s(%s) VALUES'%(
-            "IGNORE" if allow_duplicates else "",
-            table_name, 
-            ",".join(safe_col_names)))
+        # Several threads may be crawling at once. Holding the lock keeps
+        # each statement in one piece
+        result = self._get_writer(table_name)
+        with result.lock:
+            if self.target:
+                rows = list(rows)
+                # Columns only fetched to crawl are left out
+                output = self._get_output(table_name)
+                if output:
+                    (_, unsafe_col_names, output_offsets) = output
+                    rows = [[row[i] for i in output_offsets] for row in rows]
+                if rows:
+                    result.insert(table_name, unsafe_col_names, rows,
+                                  allow_duplicates)
+                return
 
-        row_strings = []
-        for row in rows:
-            callback = self.callbacks.get(table_name, None)
-            if callback:
-                row_dict = callback(self._row_dict(row, col_offsets))
-                row = [row_dict[col] for col in unsafe_col_names]
-            row_strings.append(
-                '(%s)'%",".join([make_safe(value) for value in row]))
-        result.write(",\n".join(row_strings))
-        result.write(';\n')
-
-    def _get_table(self, table_name, where=None, where_args=[]):
-        info('Exploring %s with where %s and args %s'%(table_name, where, where_args))
-        
+            # Rows are serialised and written one at a time so a whole batch
+            # is never held as a string. The statement is noted in the
+            # chunk's manifest with the range of keys in it so it can be
+            # found without reading the chunk
+            offset = result.tell()
+            summary = {}
+            for sql in self._encode_rows(table_name, rows, summary):
+                result.write(sql)
+            if summary['rows']:
+                result.add_to_manifest(table_name, offset, summary['rows'],
+                        summary['pk_min'], summary['pk_max'])
+
+    def _encode_rows(self, table_name, rows, summary):
+        '''Serialises rows as an INSERT a piece at a time. The statement is
+        only started once there is a row to go in it. The number of rows and
+        the smallest and largest key are put in summary'''
         (safe_col_names, _, _) = self._get_schema(table_name)
-        self.cursor.execute(
-                "SELECT %s FROM `%s` WHERE %s"%( 
-                    ",".join(safe_col_names),
-                    table_name,
-                    where
-                ), where_args)
+        allow_duplicates = ALLOW_DUPLICATES in self.pks[table_name].options
 
-        to_follow = defaultdict(lambda : defaultdict(set))
+        # Columns only fetched to crawl are left out
+        output = self._get_output(table_name)
+        output_offsets = None
+        if output:
+            (safe_col_names, _, output_offsets) = output
+
+        header = 'INSERT %s INTO %s(%s) VALUES'%(
+            "IGNORE" if allow_duplicates else "",
+            table_name,
+            ",".join(safe_col_names))
+        written = 0
+        pk_min = pk_max = None
+        separator = header
+        for row in rows:
+            pk = self._get_pk_value(table_name, row)
+            if output_offsets:
+                row = [row[i] for i in output_offsets]
+            yield separator
+            yield '(%s)'%",".join([make_safe(value) for value in row])
+            separator = ",\n"
+            if pk_min is None or pk < pk_min:
+                pk_min = pk
+            if pk_max is None or pk > pk_max:
+                pk_max = pk
+            written += 1
+        if written:
+            yield ';\n'
+        summary.update(rows=written, pk_min=pk_min, pk_max=pk_max)
+
+    def _send_to_encoder(self, table_name, rows):
+        '''Hands a batch to the encoding processes. Batches are written out
+        in the order they were sent, and a writer is only picked once the
+        batch is ready. The output is then the same as if the batches had
+        been serialised here'''
+        task = (table_name, self._get_schema(table_name),
+                self._get_output(table_name), rows)
+        with self._encoded_lock:
+            encoded = self.encoder.apply_async(_encode_batch, (task,))
+            self.encoded.append((table_name, encoded))
+
+            self._write_encoded(self.processes * ENCODE_QUEUE_SIZE)
+
+    def _write_encoded(self, waiting):
+        '''Writes out batches that have been encoded, in order. Waits for
+        batches to be encoded until no more than waiting are left'''
+        while self.encoded and (len(self.encoded) > waiting or
+                                self.encoded[0][1].ready()):
+            (table_name, encoded) = self.encoded.popleft()
+            (sql, summary) = encoded.get()
+            if not summary['rows']:
+                continue
+            result = self._get_writer(table_name)
+            with result.lock:
+                offset = result.tell()
+                result.write(sql)
+                result.add_to_manifest(table_name, offset, summary['rows'],
+                        summary['pk_min'], summary['pk_max'])
+
+    def _execute(self, cursor, statements, sql, args, prepared=False):
+        '''Runs a query. A prepared query uses ? placeholders and is prepared
+        on the server the first time it is run on a connection. The SQL only
+        depends on the table, columns and number of keys, so there are only
+        a few of these for each table. MySQLdb can't send arguments for a
+        prepared statement directly so they are passed in user variables.
+        Setting them and running the statement go in one round trip'''
+        if not prepared:
+            cursor.execute(sql, args)
+            return
+
+        name = statements.get(sql)
+        if name is None:
+            name = 'follow_%d'%len(statements)
+            cursor.execute('PREPARE %s FROM %%s'%name, [sql])
+            statements[sql] = name
+        variables = ['@p%d'%i for i in xrange(len(args))]
+        cursor.execute('SET %s; EXECUTE %s USING %s'%(
+            ', '.join(['%s = %%s'%variable for variable in variables]),
+            name,
+            ', '.join(variables)), args)
+        # The first result is from the SET
+        cursor.nextset()
+
+    def _fetch(self, table_name, queries, prepared=False):
+        '''Runs queries and yields the rows they find in batches. Queries are
+        given as a list of:
+            (shard, sql, args)
+        When dumping from shards each query only goes to its shard. A shard
+        of None sends the query to every shard'''
+        connections = self._local.connections
+        batch_size = self.pks[table_name].batch_size
+        on_shards = []
+        for (shard, sql, args) in queries:
+            if shard is None:
+                on_shards.extend([(i, sql, args)
+                                  for i in xrange(len(connections))])
+            else:
+                on_shards.append((shard, sql, args))
+        if len(on_shards) > 1:
+            for rows in self._fetch_from_shards(
+                    on_shards, batch_size, prepared):
+                yield rows
+            return
+
+        [(shard, sql, args)] = on_shards
+        (_, cursor) = connections[shard]
+        self._execute(cursor, self._local.statements[shard], sql, args,
+                      prepared)
         while True:
-            rows = list(self.cursor.fetchmany(self.pks[table_name].batch_size))
+            rows = cursor.fetchmany(batch_size)
             if not rows:
                 break
+            yield rows
 
-            rows = self._remove_seen_rows(table_name, rows)
-            if not rows:
-                continue
+    def _fetch_from_shards(self, queries, batch_size, prepared=False):
+        '''Runs a query on each of several shards at once and yields batches
+        as each shard gives them. Only a batch or so per shard is held at a
+        time so a big result isn't read in to memory'''
+        connections = self._local.connections
+        statements = self._local.statements
+        batches = Queue.Queue(len(queries))
+        def stream(query):
+            (shard, sql, args) = query
+            (_, cursor) = connections[shard]
+            try:
+                self._execute(cursor, statements[shard], sql, args, prepared)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    batches.put((rows, None))
+                batches.put((None, None))
+            except Exception, e:
+                batches.put((None, e))
+        for query in queries:
+            self.shard_pool.apply_async(stream, (query,))
+
+        streaming = len(queries)
+
+        error = None
+        try:
+            while streaming:
+                (rows, e) = batches.get()
+                if rows is None:
+                    streaming -= 1
+                    error = error or e
+                elif error is None:
+                    yield rows
+        finally:
+            # Every shard is read to the end, even if the rows are no longer
+            # wanted, so the connections can be used again
+            while streaming:
+                (rows, e) = batches.get()
+                if rows is None:
+                    streaming -= 1
+        if error:
+            raise error
+
+    def _join_sql(self, table_name, where, placeholder='%s'):
+        '''Builds a query for a table and the tables joined on to it. Rows
+        for the table are found by the where clause as usual, then each
+        table it joins is left joined on by its primary key. Gives:
+            (sql, args for the columns selected)'''
+        (columns, args) = self._get_select(table_name, 't0', placeholder)
+        aliases = {table_name: 't0'}
+        joins = []
+        for i, (from_table, from_columns, to_table, to_columns) in \
+                enumerate(self.joins[table_name]):
+            alias = 't%d'%(i + 1)
+            aliases[to_table] = alias
+            (to_select, to_args) = self._get_select(
+                    to_table, alias, placeholder)
+            columns.extend(to_select)
+            args.extend(to_args)
+            on = " AND ".join(["%s.`%s` = %s.`%s`"%(
+                alias, to_col, aliases[from_table], from_col)
+                for (from_col, to_col) in zip(from_columns, to_columns)])
+            joins.append("LEFT JOIN `%s` AS %s ON %s"%(to_table, alias, on))
+        sql = "SELECT %s FROM (SELECT * FROM `%s` WHERE %s) AS t0 %s"%(
+                ",".join(columns),
+                table_name,
+                where,
+                " ".join(joins))
+        return (sql, args)
+
+    def _split_joined_rows(self, table_name, rows):
+        '''Splits rows from a join back in to the rows of each table. Gives
+        a list of:
+            (table_name, rows)'''
+        table_names = [table_name] + [to_table for (_, _, to_table, _)
+                                      in self.joins[table_name]]
+        parts = []
+        start = 0
+        for name in table_names:
+            (safe_col_names, _, col_offsets) = self._get_schema(name)
+            end = start + len(safe_col_names)
+            table_rows = [row[start:end] for row in rows]
+            if name != table_name:
+                # A link to a row that isn't there comes back as NULLs
+                pk_offsets = [col_offsets[col]
+                              for col in self.pks[name].columns]
+                table_rows = [row for row in table_rows
+                              if any([row[i] is not None for i in pk_offsets])]
+            parts.append((name, table_rows))
+            start = end
+        return parts
+
+    def _get_table(self, table_name, queries, prepared=False, counts=None):
+        '''Dumps the rows matching where clauses and follows on from them.
+        The where clauses are given as a list of:
+            (shard, where, args)
+        When dumping from shards these are all run at once, each on its own
+        shard. A shard of None runs the where clause on every shard. If
+        given, the number of rows found and the number that had already been
+        dumped are added to counts'''
+        # Replaced columns are selected as arguments, which come before the
+        # arguments for the where clause
+        placeholder = '?' if prepared else '%s'
+        sql_queries = []
+        for (shard, where, where_args) in queries:
+            events.emit(LOG_INFO, 'query',
+                    table=table_name, where=where, args=len(where_args),
+                    shard=shard)
+            if table_name in self.joins:
+                (sql, args) = self._join_sql(table_name, where, placeholder)
+            else:
+                (columns, args) = self._get_select(table_name,
+                                                   placeholder=placeholder)
+                sql = "SELECT %s FROM `%s` WHERE %s"%(
+                        ",".join(columns),
+                        table_name,
+                        where)
+            sql_queries.append((shard, sql, args + list(where_args)))
+        with self._stats_lock:
+            self.queries[table_name] += len(queries)
+
+        to_follow = defaultdict(lambda : defaultdict(set))
+        # { table_name: [rows fetched, rows already dumped] }
+        table_counts = defaultdict(lambda : [0, 0])
+        if counts is not None:
+            table_counts[table_name] = counts
+        for rows in self._fetch(table_name, sql_queries, prepared):
+
+            events.emit(LOG_DEBUG, 'batch_fetched',
+                    table=table_name, rows=len(rows))
 
-            self._write_rows(table_name, rows)
-            self._calculate_follows(table_name, rows, to_follow)
+            if table_name in self.joins:
+                parts = self._split_joined_rows(table_name, rows)
+            else:
+                parts = [(table_name, rows)]
 
-        self._do_follows(to_follow)
+            # Rows from joined tables go through the same stages, so rows
+            # already dumped are still dropped. Keys for the joined rows are
+            # then seen and aren't fetched again when followed. Each stage
+            # is a generator so rows flow straight from the cursor through
+            # to the writer
+            for (name, rows) in parts:
+                rows = self._remove_seen_rows(name, rows, table_counts[name])
+                rows = self._calculate_follows(name, rows, to_follow)
+                self._write_rows(name, rows)
+
+        if self.rounds:
+            self._defer_follows(to_follow)
+        else:
+            for table, follow_sets in to_follow.iteritems():
+                self._add_pending(table, sum(
+                    [len(value_sets) for value_sets in follow_sets.values()]))
+            self._do_follows(to_follow)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -389,8 +2165,60 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', metavar="output prefix", 
                         default='dump.sql',
                         help='the prefix for the output. Default dump.sql')
+    parser.add_argument('--target-database', metavar='database',
+                        help='copy rows straight into this database instead '
+                             'of writing chunk files')
+    parser.add_argument('--target-address', metavar='address',
+                        help='the address of the target MySQL server. '
+                             'Defaults to --address')
+    parser.add_argument('--target-port', metavar='port', type=int,
+                        help='the port of the target MySQL server. '
+                             'Defaults to --port')
+    parser.add_argument('--target-username', metavar='username',
+                        help='the username for the target MySQL server. '
+                             'Defaults to --username')
+    parser.add_argument('--target-password', metavar='password',
+                        help='the password for the target MySQL server. '
+                             'Defaults to --password')
     parser.add_argument('--debug', metavar='level', choices=['info', 'debug'],
                         help='Level of debug to apply: info or debug')
+    parser.add_argument('-t', '--threads', metavar='threads', type=int,
+                        default=START_THREADS,
+                        help='the number of start points to crawl at once. '
+                             'Default %d'%START_THREADS)
+    parser.add_argument('--ordered', action='store_true',
+                        help='write tables in an order that loads with '
+                             'foreign key checks on')
+    parser.add_argument('--create-tables', action='store_true',
+                        help='include CREATE TABLE statements, with '
+                             'secondary indexes added after the rows')
+    parser.add_argument('--processes', metavar='processes', type=int,
+                        default=0,
+                        help='the number of processes to serialise rows in. '
+                             'Default 0, which serialises them as they are '
+                             'fetched')
+    parser.add_argument('--progress', action='store_true',
+                        help='report progress to stderr every %d '
+                             'seconds'%PROGRESS_INTERVAL)
+    parser.add_argument('--status-file', metavar='file',
+                        help='keep a progress report in this file')
+    parser.add_argument('--probe', action='store_true',
+                        help='fetch just the primary keys first for tables '
+                             'where most rows found have already been dumped')
+    parser.add_argument('--prepared', action='store_true',
+                        help='run follow queries as server side prepared '
+                             'statements')
+    parser.add_argument('--joins', action='store_true',
+                        help='fetch rows linked by primary key in the same '
+                             'query using JOINs')
+    parser.add_argument('--rounds', action='store_true',
+                        help='follow keys a table at a time in rounds, '
+                             'which needs fewer queries on linked tables')
+    parser.add_argument('--estimate', action='store_true',
+                        help='estimate the size of the dump without '
+                             'fetching any rows')
+    parser.add_argument('--log-file', metavar='file',
+                        help='where to write debug events. Default stderr')
     parser.add_argument('dumpschema',
                         help='the python dumpschema to use')
     args = parser.parse_args()
@@ -399,13 +2227,25 @@ if __name__ == "__main__":
         DEBUG_LEVEL = LOG_DEBUG
     elif args.debug == 'info':
         DEBUG_LEVEL = LOG_INFO
+    if args.log_file:
+        events.stream = open(args.log_file, 'a')
+
+    target = None
+    if args.target_database:
+        target = {
+            'host': args.target_address or args.address,
+            'port': args.target_port or args.port,
+            'user': args.target_username or args.username,
+            'passwd': args.target_password or args.password,
+            'db': args.target_database,
+        }
 
     dumpschema = args.dumpschema
     dumpschema = dumpschema[:dumpschema.rfind('.')]
 
     try:
         m = __import__(dumpschema)
-        Dumper(
+        dumper = Dumper(
                 m.relationships, 
                 m.pks, 
                 m.callbacks,
@@ -414,12 +2254,32 @@ if __name__ == "__main__":
                 args.username,
                 args.password,
                 args.database,
-                m.start_table,
-                m.start_where,
-                m.start_args,
+                getattr(m, 'start_table', None),
+                getattr(m, 'start_where', None),
+                getattr(m, 'start_args', []),
                 m.end_sql,
                 args.chunks,
-                args.output).go()
+                args.output,
+                target=target,
+                batch_callbacks=getattr(m, 'batch_callbacks', {}),
+                starts=getattr(m, 'starts', None),
+                threads=args.threads,
+                shards=getattr(m, 'shards', None),
+                shard_router=getattr(m, 'shard_router', None),
+                ordered=args.ordered,
+                create_tables=args.create_tables,
+                rounds=args.rounds,
+                joins=args.joins,
+                prepared=args.prepared,
+                probe=args.probe,
+                progress=args.progress,
+                status_file=args.status_file,
+                processes=args.processes)
+
+        if args.estimate:
+            print dumper.estimate()
+        else:
+            dumper.go()
     except ImportError, e:
         print 'Failed to import %s:'%dumpschema
         print e
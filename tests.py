@@ -4,7 +4,11 @@ import mysqlpartialdump as dumper
 from cStringIO import StringIO
 from mysqlpartialdump import BIDIRECTIONAL, ALLOW_DUPLICATES
 from mysqlpartialdump import Pk, From, CustomRelationship
+from mysqlpartialdump import Anonymize, Hash, Mask, Fake
+from mysqlpartialdump import ChunkManifest
 import os.path
+import json
+import threading
 
 def init_connection():
     try:
@@ -16,6 +20,9 @@ DB_PORT = 3306
 DB_USERNAME = someuser
 DB_PASSWORD = somepassword
 DB_NAME = somedatabase
+
+TARGET_DB_NAME can optionally be set to a second database to test copying
+straight between databases.
 '''
         raise 
     db = MySQLdb.connect(
@@ -79,8 +86,15 @@ class TestImport(unittest.TestCase):
         if self.db is not None:
             self.db.close()
 
-    def do_partial_dump(self, relationships, start_table, start_where, pks=None, row_callbacks={}, end_sql='', chunks=1):
+    def do_partial_dump(self, *args, **kwargs):
         '''Helper method to make running a dump a bit tidier in tests'''
+        dump = self.create_dumper(*args, **kwargs)
+        dump.go()
+        return dump
+
+    def create_dumper(self, relationships, start_table, start_where, pks=None, row_callbacks={}, end_sql='', chunks=1, target=None, batch_callbacks={}, output_prefix=TEST_OUTPUT_PREFIX, **kwargs):
+        '''Creates a dumper for the test database. Any other options are
+        passed on to the dumper'''
         if not pks:
             pks = {
                 'owner': Pk(['id']),
@@ -101,9 +115,12 @@ class TestImport(unittest.TestCase):
                 start_where=start_where,
                 end_sql=end_sql,
                 chunks=chunks,
-                output_prefix=TEST_OUTPUT_PREFIX
+                output_prefix=output_prefix,
+                target=target,
+                batch_callbacks=batch_callbacks,
+                **kwargs
                 )
-        dump.go()
+        return dump
 
     def create_pet(self, id, name, parent_id, owner_id):
         sql = 'INSERT INTO pet(id, name, parent_id, owner_id) VALUES(%s, %s, %s, %s)'
@@ -211,6 +228,36 @@ class TestImport(unittest.TestCase):
         self.assertEquals(1, len(owners))
         self.assertEquals('Bo******', owners[1]['name'])
 
+    def test_batch_callbacks(self):
+        self.create_owner(1, 'Bob')
+        self.create_owner(2, 'Bob')
+        self.create_owner(3, 'Alan')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        self.create_pet(2, 'Tabby', parent_id=None, owner_id=2)
+        mask = Mask(keep=2)
+        batch_callbacks = {
+            'owner': Anonymize(name=mask),
+            'pet': Anonymize(name=Fake(['Rex'])),
+        }
+        relations = [
+            From('owner', 'id').to('pet', 'owner_id'),
+        ]
+        self.do_partial_dump(relations, 'owner', '1=1',
+                batch_callbacks=batch_callbacks)
+
+        self.import_dump()
+
+        owners = self.get_owners()
+        self.assertEquals('Bo*', owners[1]['name'])
+        self.assertEquals('Bo*', owners[2]['name'])
+        self.assertEquals('Al**', owners[3]['name'])
+        pets = self.get_pets()
+        self.assertEquals('Rex', pets[1]['name'])
+        self.assertEquals('Rex', pets[2]['name'])
+        # Repeated values should only be transformed once
+        self.assertEquals(1, mask.cache.hits)
+        self.assertEquals(2, mask.cache.misses)
+
     def test_empty_string(self):
         self.create_owner(1, '')
         self.do_partial_dump({}, 'owner', 'id=1')
@@ -236,6 +283,22 @@ class TestImport(unittest.TestCase):
         owners = self.get_owners()
         self.assertEquals(100, len(owners))
 
+    def test_bounded_output_buffer(self):
+        # Output should be streamed through a small buffer rather than being
+        # built up a batch at a time
+        for a in xrange(1, 101):
+            self.create_owner(a, 'Bob')
+        original_size = dumper.OUTPUT_BUFFER_SIZE
+        dumper.OUTPUT_BUFFER_SIZE = 64
+        try:
+            dump = self.do_partial_dump({}, 'owner', '1=1')
+        finally:
+            dumper.OUTPUT_BUFFER_SIZE = original_size
+
+        self.import_dump()
+        self.assertEquals(100, len(self.get_owners()))
+        self.assertTrue(dump.peak_buffered < 200)
+
     def test_many_rows_two_chunks(self):
         # Creating two chunks and importing them should work fine
         for x in xrange(1, 201):
@@ -478,6 +541,526 @@ class TestImport(unittest.TestCase):
         }
         self.do_partial_dump({}, 'owner', 'id=1', pks=pks)
 
+    def test_event_log(self):
+        self.create_owner(1, 'Bob')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ]
+        original_level = dumper.DEBUG_LEVEL
+        original_stream = dumper.events.stream
+        output = StringIO()
+        dumper.events.stream = output
+        try:
+            # Nothing should be written when logging is off
+            self.do_partial_dump(relations, 'owner', '1=1')
+            self.assertEquals('', output.getvalue())
+
+            dumper.DEBUG_LEVEL = dumper.LOG_DEBUG
+            self.do_partial_dump(relations, 'owner', '1=1')
+        finally:
+            dumper.DEBUG_LEVEL = original_level
+            dumper.events.stream = original_stream
+
+        # Each line should be a JSON event
+        events = [json.loads(line) for line in output.getvalue().splitlines()]
+        names = set([event['event'] for event in events])
+        self.assertTrue('query' in names)
+        self.assertTrue('batch_fetched' in names)
+        self.assertTrue('keys_deduped' in names)
+        queries = [event for event in events if event['event'] == 'query']
+        self.assertEquals(['owner', 'pet'],
+                [event['table'] for event in queries])
+
+    def test_event_log_rate_limit(self):
+        output = StringIO()
+        log = dumper.EventLog(output, per_second=2)
+        original_level = dumper.DEBUG_LEVEL
+        dumper.DEBUG_LEVEL = dumper.LOG_INFO
+        try:
+            for i in xrange(5):
+                log.emit(dumper.LOG_INFO, 'query', n=i)
+            log.emit(dumper.LOG_DEBUG, 'query', n=5)
+        finally:
+            dumper.DEBUG_LEVEL = original_level
+        self.assertEquals(2, len(output.getvalue().splitlines()))
+
+    def test_estimate(self):
+        for x in xrange(1, 11):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        c = self.db.cursor()
+        c.execute('ANALYZE TABLE owner, pet')
+        c.fetchall()
+        c.close()
+        relations = [
+            From('owner', 'id').to('pet', 'owner_id'),
+        ]
+        pks = { 'owner': Pk(['id']), 'pet': Pk(['id']).in_batches(4) }
+        estimate = self.create_dumper(relations, 'owner', 'id <= %s',
+                                      pks=pks, start_args=[5]).estimate()
+        self.assertTrue(estimate.tables['owner']['rows'] > 0)
+        self.assertTrue(estimate.tables['pet']['rows'] > 0)
+        self.assertEquals(1, estimate.tables['owner']['queries'])
+        self.assertTrue(estimate.tables['pet']['queries'] >= 1)
+        self.assertEquals(1, estimate.chunks)
+        self.assertTrue('Recommended --chunks: 1' in str(estimate))
+
+    def test_multiple_starts(self):
+        # Start points that overlap should only dump shared rows once
+        for x in xrange(1, 21):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ]
+        pks = { 'owner': Pk(['id']), 'pet': Pk(['id']).in_batches(3) }
+        self.do_partial_dump(relations, None, None, pks=pks, chunks=2,
+                starts=[
+                    ('owner', 'id <= %s', [10]),
+                    ('owner', 'id > %s', [5]),
+                    ('pet', 'owner_id = %s', [7]),
+                ],
+                threads=3)
+
+        # A row dumped twice would fail to import
+        self.import_dump(chunks=2)
+        self.assertEquals(20, len(self.get_owners()))
+        self.assertEquals(20, len(self.get_pets()))
+
+    def test_multiple_starts_fetch_keys_once(self):
+        # Each start point finds different pets with the same owners. Both
+        # threads follow the owners at the same time but each owner should
+        # only be fetched by one of them
+        for x in xrange(1, 11):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+            self.create_pet(x + 10, 'Tabby', parent_id=None, owner_id=x)
+        # Hold each thread back until both are about to follow owners
+        arrived = []
+        lock = threading.Lock()
+        both_arrived = threading.Event()
+        original_do_follows = dumper.Dumper._do_follows
+        def do_follows(self, to_follow):
+            if 'owner' in to_follow and not both_arrived.is_set():
+                with lock:
+                    arrived.append(threading.current_thread())
+                    if len(arrived) == 2:
+                        both_arrived.set()
+                both_arrived.wait(5)
+            original_do_follows(self, to_follow)
+        dumper.Dumper._do_follows = do_follows
+        try:
+            d = self.do_partial_dump(
+                    [From('pet', 'owner_id').to('owner', 'id')],
+                    None, None,
+                    starts=[('pet', 'id <= %s', [10]),
+                            ('pet', 'id > %s', [10])],
+                    threads=2)
+        finally:
+            dumper.Dumper._do_follows = original_do_follows
+        self.assertEquals(10, d.fetched['owner'])
+        self.assertEquals(0, d.duplicates['owner'])
+
+    def test_rounds(self):
+
+        # Small batches mean keys for owners and pets turn up a few at a
+        # time. Following them in rounds should need fewer queries
+        for x in xrange(1, 11):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+            self.create_pet(x + 10, 'Tabby', parent_id=x, owner_id=x % 10 + 1)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+            From('pet', 'parent_id').to('pet', 'id'),
+        ]
+        pks = {
+            'owner': Pk(['id']).in_batches(2),
+            'pet': Pk(['id']).in_batches(2),
+        }
+        queries = []
+        for rounds in [False, True]:
+            d = self.do_partial_dump(relations, 'owner', 'id <= 5', pks=pks,
+                                     rounds=rounds)
+            queries.append(sum(d.queries.values()))
+
+        self.assertTrue(queries[1] < queries[0])
+        self.import_dump()
+        self.assertEquals(10, len(self.get_owners()))
+        self.assertEquals(20, len(self.get_pets()))
+
+    def test_joins(self):
+        # Pets link to the primary key of owners so owners can be fetched in
+        # the same query. Owners with two pets must still be dumped once
+        for x in xrange(1, 6):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+            self.create_pet(x + 5, 'Tabby', parent_id=x, owner_id=x)
+        pks = { 'owner': Pk(['id']), 'pet': Pk(['id']).in_batches(3) }
+        d = self.do_partial_dump([From('pet', 'owner_id').to('owner', 'id')],
+                                 'pet', 'id > %s', pks=pks, start_args=[0],
+                                 joins=True)
+
+        self.assertEquals({'pet': 1}, dict(d.queries))
+        self.import_dump()
+        self.assertEquals(5, len(self.get_owners()))
+        self.assertEquals(10, len(self.get_pets()))
+
+    def test_joins_bidirectional(self):
+        # Pets link to the primary keys of both owners and logs. Going back
+        # the other way doesn't link to a primary key so both are joined on
+        for x in xrange(1, 6):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+            self.create_log(x, 'Pet%d'%x, 'Hello')
+        d = self.do_partial_dump([
+            From('owner', 'id').to('pet', 'owner_id').bidirectional(),
+            From('pet', 'id').to('log', 'id').bidirectional(),
+        ], 'pet', '1=1', joins=True)
+
+        self.assertEquals(['log', 'owner'], sorted(
+            [to_table for (_, _, to_table, _) in d.joins['pet']]))
+        # Owners lead back to their pets, which takes another query
+        self.assertEquals({'pet': 2}, dict(d.queries))
+
+        self.import_dump()
+        self.assertEquals(5, len(self.get_owners()))
+        self.assertEquals(5, len(self.get_pets()))
+        self.assertEquals(5, len(self.get_logs()))
+
+    def test_joins_with_where(self):
+
+        # A link with a where clause isn't joined so the owners it leaves
+        # out aren't dumped
+        for x in xrange(1, 6):
+            self.create_owner(x, 'Bob%d'%x)
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        d = self.do_partial_dump([
+            From('pet', 'owner_id').to('owner', 'id').where(
+                'name = %s', 'Bob1'),
+        ], 'pet', '1=1', joins=True)
+
+        self.assertEquals({}, d.joins)
+        self.import_dump()
+        self.assertEquals([1], self.get_owners().keys())
+        self.assertEquals(5, len(self.get_pets()))
+
+    def test_prepared(self):
+        # Padding a batch by repeating the last key mustn't dump it twice
+        for x in xrange(1, 21):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ]
+        pks = { 'owner': Pk(['id']).in_batches(6), 'pet': Pk(['id']) }
+        d = self.do_partial_dump(relations, 'pet', '1=1', pks=pks,
+                                 prepared=True)
+
+        # Batches of 6 keys are padded to 8 and the last batch of 2 isn't
+        # padded. Owners and pets then need two statements each however many
+        # batches are run
+        self.assertEquals(4, d.queries['owner'])
+        self.assertEquals(4, len(d._local.statements[0]))
+
+        self.import_dump()
+        self.assertEquals(20, len(self.get_owners()))
+        self.assertEquals(20, len(self.get_pets()))
+
+    def test_probe(self):
+        # Every pet is dumped first so following owners back to their pets
+        # only finds pets already dumped. Once that's been seen only the
+        # keys of pets should be fetched
+        for x in xrange(1, 11):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ]
+        pks = {
+            'owner': Pk(['id']).in_batches(3),
+            'pet': Pk(['id']),
+        }
+        fetched = []
+        for probe in [False, True]:
+            d = self.do_partial_dump(relations, 'pet', '1=1', pks=pks,
+                                     probe=probe)
+            fetched.append(d.fetched['pet'])
+
+        # The first batch of 3 owners is followed in full, the rest probed
+        self.assertEquals([20, 13], fetched)
+        self.import_dump()
+        self.assertEquals(10, len(self.get_owners()))
+        self.assertEquals(10, len(self.get_pets()))
+
+    def test_column_projection(self):
+        # parent_id isn't dumped but is still needed to find the parent
+        self.create_owner(1, 'Bob')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        self.create_pet(2, 'Tabby', parent_id=1, owner_id=1)
+        relations = [
+            From('pet', 'parent_id').to('pet', 'id'),
+            From('pet', 'owner_id').to('owner', 'id'),
+        ]
+        pks = {
+            'owner': Pk(['id']).replacing(name='100% Anon'),
+            'pet': Pk(['id']).excluding('parent_id'),
+            'log': Pk(['id']),
+        }
+        self.do_partial_dump(relations, 'pet', 'id = 2', pks=pks)
+
+        f = open("%s.%d"%(TEST_OUTPUT_PREFIX, 0), 'r')
+        dump = f.read()
+        f.close()
+        self.assertFalse('parent_id' in dump)
+        self.assertFalse('Bob' in dump)
+
+        self.import_dump()
+        pets = self.get_pets()
+        self.assertEquals(2, len(pets))
+        self.assertEquals(None, pets[2]['parent_id'])
+        self.assertEquals('100% Anon', self.get_owners()[1]['name'])
+
+    def test_relationship_where(self):
+        self.create_owner(1, 'Bob')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        self.create_pet(2, 'Tabby', parent_id=None, owner_id=1)
+        self.do_partial_dump([
+            From('owner', 'id').to('pet', 'owner_id').where(
+                'name != %s', 'Tabby'),
+        ], 'owner', 'id = 1')
+        self.import_dump()
+        self.assertEquals([1], sorted(self.get_pets().keys()))
+
+    def test_relationship_where_bidirectional(self):
+        # The predicate only narrows down the owners followed to. Following
+        # back to pets finds every pet even though none match
+        self.create_owner(1, 'Bob')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        self.create_pet(2, 'Tabby', parent_id=None, owner_id=1)
+        self.do_partial_dump([
+            From('pet', 'owner_id').to('owner', 'id').where(
+                'name = %s', 'Nobody').bidirectional(),
+        ], 'owner', 'id = 1')
+        self.import_dump()
+        self.assertEquals([1, 2], sorted(self.get_pets().keys()))
+
+    def test_progress(self):
+        for x in xrange(1, 6):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        status_file = '%s.status'%TEST_OUTPUT_PREFIX
+        self.do_partial_dump([
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ], 'owner', '1=1', status_file=status_file)
+
+        # The final report is left in the status file with nothing pending
+        f = open(status_file, 'r')
+        lines = [line.split() for line in f.read().splitlines()]
+        f.close()
+        self.assertTrue('rows dumped' in ' '.join(lines[0]))
+        self.assertTrue(['owner', '5', '0'] in [line[:3] for line in lines])
+        self.assertTrue(['pet', '5', '0'] in [line[:3] for line in lines])
+        self.assertTrue('%s.0'%TEST_OUTPUT_PREFIX in
+                        [line[0] for line in lines])
+
+    def test_progress_during_query(self):
+        # Rows are counted as each batch is read rather than once the query
+        # has finished
+        for x in xrange(1, 6):
+            self.create_owner(x, 'Bob')
+        counted = []
+        def owner_callback(row):
+            counted.append(d.fetched['owner'])
+            return row
+        d = self.create_dumper([], 'owner', '1=1',
+                               pks={ 'owner': Pk(['id']).in_batches(2) },
+                               row_callbacks={ 'owner': owner_callback })
+        d.go()
+        self.assertEquals([0, 0, 2, 2, 4], counted)
+
+    def test_processes(self):
+        # Batches encoded in other processes are written out as they would
+        # have been without them
+        for x in xrange(1, 21):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ]
+        pks = {
+            'owner': Pk(['id']).in_batches(3),
+            'pet': Pk(['id']).in_batches(4),
+        }
+        outputs = []
+        for processes in (0, 2):
+            prefix = '%s.%d'%(TEST_OUTPUT_PREFIX, processes)
+            self.do_partial_dump(relations, 'owner', '1=1', pks=pks, chunks=2,
+                                 output_prefix=prefix, processes=processes)
+            chunks = []
+            for chunk in xrange(2):
+                f = open('%s.%d'%(prefix, chunk), 'r')
+                chunks.append(f.read())
+                f.close()
+            outputs.append(chunks)
+
+        self.assertEquals(outputs[0], outputs[1])
+        self.assertTrue('INSERT' in outputs[1][1])
+
+    def test_chunk_manifest(self):
+        for x in xrange(1, 11):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ]
+        pks = {
+            'owner': Pk(['id']).in_batches(3),
+            'pet': Pk(['id']),
+        }
+        self.do_partial_dump(relations, 'pet', '1=1', pks=pks, chunks=2)
+
+        manifests = [ChunkManifest('%s.%d'%(TEST_OUTPUT_PREFIX, chunk))
+                     for chunk in xrange(2)]
+        entries = [entry for manifest in manifests
+                   for entry in manifest.find('owner')]
+        self.assertEquals(4, len(entries))
+        self.assertEquals(10, sum([entry['rows'] for entry in entries]))
+
+        # Restore only the owners with keys 4 to 6
+        c = self.db.cursor()
+        c.execute('DELETE FROM owner')
+        self.db.commit()
+        c.close()
+        for manifest in manifests:
+            for statement in manifest.statements('owner', (4,), (6,)):
+                self.assertTrue(statement.startswith('INSERT'))
+                c = self.db.cursor()
+                c.execute(statement)
+                c.close()
+        owners = self.get_owners()
+        self.assertTrue(all([x in owners for x in [4, 5, 6]]))
+        self.assertTrue(len(owners) < 10)
+
+    def test_shards(self):
+        # Both shards are the test database here so every row is on both.
+        # Each row should still only be dumped once
+        for x in xrange(1, 11):
+            self.create_owner(x, 'Bob')
+            self.create_pet(x, 'Ginger', parent_id=None, owner_id=x)
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+        ]
+        routed = []
+        def router(table_name, key):
+            routed.append(table_name)
+            if 'id' in key:
+                return key['id'] % 2
+            return None
+        pks = {
+            'owner': Pk(['id']).in_batches(2),
+            'pet': Pk(['id']).in_batches(2),
+        }
+        import test_config
+        for shard_router in [None, router]:
+            self.do_partial_dump(relations, 'pet', '1=1', pks=pks,
+                                 shards=[{}, { 'db': test_config.DB_NAME }],
+                                 shard_router=shard_router)
+
+            self.import_dump()
+            self.assertEquals(10, len(self.get_owners()))
+            self.assertEquals(10, len(self.get_pets()))
+        self.assertTrue('owner' in routed)
+
+    def test_ordered_output(self):
+        self.create_owner(1, 'Bob')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        self.create_pet(2, 'Tabby', parent_id=1, owner_id=1)
+        self.create_log(1, 'Pet1', 'Hello')
+        def get_logs_relationship(row):
+            return ('log', [('entity', 'Pet%s'%row['id'])])
+        relations = [
+            From('pet', 'owner_id').to('owner', 'id').bidirectional(),
+            From('pet', 'parent_id').to('pet', 'id'),
+            CustomRelationship('pet', get_logs_relationship),
+        ]
+        self.do_partial_dump(relations, 'pet', '1=1',
+                             end_sql="INSERT INTO owner(name) VALUES('Alan');",
+                             chunks=2, ordered=True)
+
+        def read(layer, chunk):
+            f = open('%s.%d.%d'%(TEST_OUTPUT_PREFIX, layer, chunk), 'r')
+            result = f.read()
+            f.close()
+            return result
+
+        # Owners and logs depend on nothing so can be loaded side by side.
+        # Pets refer to owners and to each other
+        layer0 = [read(0, 0), read(0, 1)]
+        self.assertEquals(1, len([d for d in layer0 if 'INTO owner' in d]))
+        self.assertEquals(1, len([d for d in layer0 if 'INTO log' in d]))
+        self.assertFalse('FOREIGN_KEY_CHECKS' in ''.join(layer0))
+        layer1 = read(1, 0)
+        self.assertTrue('INTO pet' in layer1)
+        self.assertTrue('SET FOREIGN_KEY_CHECKS=0' in layer1)
+        self.assertFalse(os.path.exists(
+            '%s.%d.%d'%(TEST_OUTPUT_PREFIX, 1, 1)))
+        self.assertTrue('Alan' in read(2, 0))
+
+        c = self.db.cursor()
+        c.execute('DELETE FROM pet')
+        c.execute('DELETE FROM owner')
+        c.execute('DELETE FROM log')
+        self.db.commit()
+        c.close()
+        for dump in layer0 + [layer1, read(2, 0)]:
+            c = self.db.cursor()
+            c.execute(dump)
+            c.close()
+
+        self.assertEquals(2, len(self.get_owners()))
+        self.assertEquals(2, len(self.get_pets()))
+        self.assertEquals(1, len(self.get_logs()))
+
+    def test_ordered_output_no_rows(self):
+        self.create_owner(1, 'Bob')
+        d = self.do_partial_dump([], 'owner', 'id > 100', ordered=True)
+        self.assertEquals(0, d.peak_buffered)
+
+    def test_create_tables(self):
+        self.create_owner(1, 'Bob')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        relations = [
+            From('owner', 'id').to('pet', 'owner_id'),
+        ]
+        self.do_partial_dump(relations, 'owner', '1=1', create_tables=True)
+
+        def read(name):
+            f = open('%s.%s'%(TEST_OUTPUT_PREFIX, name), 'r')
+            result = f.read()
+            f.close()
+            return result
+
+        # The index on pet.owner_id should only be added after the rows
+        schema = read('schema')
+        indexes = read('indexes.0')
+        self.assertTrue('CREATE TABLE `pet`' in schema)
+        self.assertTrue('CREATE TABLE `owner`' in schema)
+        self.assertFalse('owner_id` (' in schema)
+        self.assertTrue('ALTER TABLE `pet`' in indexes)
+        self.assertTrue('`owner_id`' in indexes)
+
+        for dump in [schema, read('0'), indexes]:
+            c = self.db.cursor()
+            c.execute(dump)
+            c.close()
+        self.assertEquals(1, len(self.get_owners()))
+        self.assertEquals(1, len(self.get_pets()))
+        c = self.db.cursor()
+        c.execute('SHOW CREATE TABLE `pet`')
+        self.assertTrue('KEY `owner_id`' in c.fetchall()[0][1])
+        c.close()
+
     def test_end_sql(self):
         self.create_owner(1, 'Bob')
         self.do_partial_dump({}, 'owner', 'id=1', end_sql="""
@@ -493,3 +1076,57 @@ class TestImport(unittest.TestCase):
         self.assertEquals('Bob', owners[1]['name'])
         self.assertEquals('Alan', owners[2]['name'])
 
+    def test_copy_to_database(self):
+        import test_config
+        target_name = getattr(test_config, 'TARGET_DB_NAME', None)
+        if not target_name:
+            self.skipTest('TARGET_DB_NAME not set in test_config')
+        target = {
+            'host': test_config.DB_ADDRESS,
+            'port': test_config.DB_PORT,
+            'user': test_config.DB_USERNAME,
+            'passwd': test_config.DB_PASSWORD,
+            'db': target_name,
+        }
+        target_db = MySQLdb.connect(**target)
+        c = target_db.cursor()
+        self.drop(c, 'pet')
+        self.drop(c, 'owner')
+        c.execute('''
+            CREATE TABLE owner (
+            `id` INT NOT NULL AUTO_INCREMENT,
+            `name` VARCHAR(30) NOT NULL,
+            PRIMARY KEY (`id`)
+            );''')
+        c.execute('''
+            CREATE TABLE pet (
+            `id` INT NOT NULL AUTO_INCREMENT,
+            `name` VARCHAR(30) NOT NULL,
+            `parent_id` INT NULL,
+            `owner_id` INT NOT NULL,
+            PRIMARY KEY (`id`)
+            );''')
+        c.close()
+
+        self.create_owner(1, 'Bob')
+        self.create_pet(1, 'Ginger', parent_id=None, owner_id=1)
+        self.create_pet(2, 'Tabby', parent_id=None, owner_id=1)
+        relations = [
+            From('owner', 'id').to('pet', 'owner_id'),
+        ]
+        def owner_callback(row):
+            row['name'] = 'Anon'
+            return row
+        self.do_partial_dump(relations, 'owner', '1=1',
+                row_callbacks={ 'owner': owner_callback },
+                end_sql="INSERT INTO owner(name) VALUES('Alan');",
+                chunks=2, target=target)
+
+        # Rows should be in the target database and no chunk files written
+        c = target_db.cursor()
+        c.execute('SELECT id, name FROM owner ORDER BY id')
+        self.assertEquals([(1, 'Anon'), (2, 'Alan')], list(c.fetchall()))
+        c.execute('SELECT id FROM pet ORDER BY id')
+        self.assertEquals([(1,), (2,)], list(c.fetchall()))
+        c.close()
+        target_db.close()
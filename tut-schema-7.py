@@ -0,0 +1,27 @@
+from mysqlpartialdump import Pk, From, Anonymize, Hash
+
+pks = {
+    'Customer': Pk(['id']),
+    'Order': Pk(['id']),
+    'OrderLine': Pk(['id']),
+    'Product': Pk(['id']),
+}
+
+relationships = [
+    From('Customer', 'id').to('Order', 'customer_id').bidirectional(),
+    From('Order', 'id').to('OrderLine', 'order_id').bidirectional(),
+    From('OrderLine', 'product_id').to('Product', 'id').bidirectional(),
+]
+
+callbacks = {
+}
+
+batch_callbacks = {
+    'Customer': Anonymize(email=Hash(keep=3)),
+}
+
+end_sql = ""
+
+start_table = 'Product'
+start_where = '1=1'
+start_args = []